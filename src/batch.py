@@ -0,0 +1,165 @@
+"""
+ Prognoses of many balance workbooks and horizons in one run.
+
+ A manifest lists the inputs, each with the folder to save its prognoses in and the horizons to calculate:
+
+    [{"input": "home.xlsx", "folder": "out/home", "horizons": [[1, 0], [5, 0]]},
+     {"input": "company.xlsx", "folder": "out", "horizons": [[0, 6]], "formulas": true},
+     {"input": "company.xlsx", "folder": "rows", "horizons": [[2, 0]], "format": "jsonl", "per_month": true},
+     {"input": "bank.csv", "folder": "out", "horizons": [[1, 0]], "encoding": "cp1252", "decimal_mark": ","}]
+
+ CSV and TSV inputs are UTF-8 with a decimal point, unless an input gives its encoding and decimal mark.
+
+ Every input is read once for all its horizons. The inputs are spread over a pool of processes, and a summary of
+ the prognoses saved and the failures is written as JSON.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+
+import rowexport
+from budgetcalc import BudgetCalc, PARSER_VERSION
+from inputcache import InputCache, DEFAULT_DIRECTORY
+
+
+def read_manifest(filename):
+    with open(filename) as manifest_file:
+        entries = json.load(manifest_file)
+
+    if not isinstance(entries, list):
+        raise ValueError("The manifest should be a list of inputs")
+    return entries
+
+
+def run_entry(job):
+    """
+    Saves the prognoses of one manifest entry. Returns a result for every horizon, each with either the filename
+    of the prognosis or the error that prevented it.
+    """
+    entry, options = job
+    results = []
+    try:
+        filename = entry["input"]
+        folder = entry["folder"]
+        horizons = list(entry["horizons"])
+        write_only = entry.get("write_only", options["write_only"])
+        formulas = entry.get("formulas", options["formulas"])
+        summary = entry.get("summary", options["summary"])
+        output_format = entry.get("format", options["output_format"])
+        per_month = entry.get("per_month", options["per_month"])
+
+        start = time.time()
+        cache = InputCache(PARSER_VERSION, directory=options["cache_dir"]) if options["cache_dir"] else None
+        calculator = BudgetCalc(cache=cache)
+        calculator.read_input(filename, encoding=entry.get("encoding"), decimal_mark=entry.get("decimal_mark", "."))
+        read_seconds = time.time() - start
+
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # Another process may have created it in the meantime.
+                if not os.path.isdir(folder):
+                    raise
+    except Exception as error:
+        return [_failure(entry, None, error)]
+
+    # The prognoses of different inputs can share a folder, so their filenames carry the name of the input.
+    tag = os.path.splitext(os.path.basename(filename))[0]
+    for horizon in horizons:
+        start = time.time()
+        try:
+            # A bad horizon fails on its own, the others of the entry are still saved.
+            years, months = [int(value) for value in horizon]
+            output = calculator.save_prognosis(folder, years=years, months=months, write_only=write_only,
+                                               formulas=formulas, tag=tag, exclusive=True, summary=summary,
+                                               output_format=output_format, per_month=per_month)
+        except Exception as error:
+            results.append(_failure(entry, horizon, error))
+            continue
+
+        results.append({"input": filename, "years": years, "months": months, "output": output,
+                        "read_seconds": round(read_seconds, 3), "export_seconds": round(time.time() - start, 3)})
+
+    return results
+
+
+def _failure(entry, horizon, error):
+    failure = {"input": entry.get("input") if isinstance(entry, dict) else None,
+               "error": "{0}: {1}".format(type(error).__name__, error), "traceback": traceback.format_exc()}
+    if isinstance(horizon, (list, tuple)) and len(horizon) == 2:
+        failure["years"], failure["months"] = horizon
+    elif horizon is not None:
+        failure["horizon"] = horizon
+    return failure
+
+
+def run_batch(entries, workers=1, cache_dir=DEFAULT_DIRECTORY, write_only=False, formulas=False, summary=False,
+              output_format="xlsx", per_month=False):
+    """
+    Runs all entries of a manifest and returns the summary.
+    """
+    options = {"cache_dir": cache_dir, "write_only": write_only, "formulas": formulas, "summary": summary,
+               "output_format": output_format, "per_month": per_month}
+    jobs = [(entry, options) for entry in entries]
+
+    start = time.time()
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        try:
+            entry_results = pool.map(run_entry, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        entry_results = [run_entry(job) for job in jobs]
+
+    results = [result for results in entry_results for result in results]
+    return {"outputs": [result for result in results if "output" in result],
+            "failures": [result for result in results if "error" in result],
+            "seconds": round(time.time() - start, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calculate the budget prognoses listed in a manifest.")
+    parser.add_argument("manifest", help="JSON list of inputs, each with its folder and horizons")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="number of processes handling inputs in parallel (default: %(default)s)")
+    parser.add_argument("--summary", help="file to write the summary to, instead of the standard output")
+    parser.add_argument("--write-only", action="store_true", help="stream the prognoses, unless an input says not to")
+    parser.add_argument("--formulas", action="store_true",
+                        help="calculate the balances with formulas, unless an input says not to")
+    parser.add_argument("--summary-sheet", action="store_true",
+                        help="add a sheet of the month-end balances to the prognoses, unless an input says not to")
+    parser.add_argument("--format", choices=("xlsx",) + rowexport.FORMATS, default="xlsx",
+                        help="format of the prognoses, unless an input says otherwise (default: %(default)s)")
+    parser.add_argument("--per-month", action="store_true",
+                        help="with a row format, save every month in a file of its own, unless an input says not to")
+    parser.add_argument("--cache-dir", default=DEFAULT_DIRECTORY,
+                        help="folder of the cache of parsed inputs (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="always parse the input workbooks")
+    args = parser.parse_args()
+
+    summary = run_batch(read_manifest(args.manifest), workers=args.workers,
+                        cache_dir=None if args.no_cache else args.cache_dir, write_only=args.write_only,
+                        formulas=args.formulas, summary=args.summary_sheet, output_format=args.format,
+                        per_month=args.per_month)
+
+    text = json.dumps(summary, indent=2, sort_keys=True)
+    if args.summary:
+        with open(args.summary, "w") as summary_file:
+            summary_file.write(text + "\n")
+    else:
+        print text
+
+    print >> sys.stderr, "{0} prognoses saved, {1} failed".format(len(summary["outputs"]), len(summary["failures"]))
+    sys.exit(1 if summary["failures"] else 0)
+
+
+if __name__ == '__main__':
+    main()
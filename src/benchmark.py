@@ -0,0 +1,198 @@
+"""
+ Benchmarks of reading a balance workbook and saving its prognosis, on generated inputs.
+
+ Every case is run in a process of its own, so the peak memory reported is that of the case alone. The time of every
+ phase comes from the instrumentation spans of the run. The results are printed as JSON, to compare versions of the
+ code on the same machine.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import date, datetime
+
+import openpyxl
+from openpyxl import Workbook
+
+import recurrence
+import monthcalendar
+import instrumentation
+from budgetcalc import BudgetCalc, TransactionWorkbook
+
+# Kinds of recurrence, each as a function giving the interval, repetitions and quotes (cuotas) of a transaction.
+RECURRENCES = {
+    "monthly": lambda rnd: (None, None, None),
+    "n-monthly": lambda rnd: (rnd.choice([2, 3, 6, 12]), None, None),
+    "even": lambda rnd: (recurrence.EVEN_MONTHS, None, None),
+    "uneven": lambda rnd: (recurrence.UNEVEN_MONTHS, None, None),
+    "cuotas": lambda rnd: _cuotas(rnd),
+    "limited": lambda rnd: (rnd.choice([None, 1, 2]), rnd.randint(1, 24), None),
+}
+
+# Mixes of recurrences, as the relative weight of every kind
+MIXES = {
+    "monthly": {"monthly": 1},
+    "cuotas": {"cuotas": 1},
+    "mixed": {"monthly": 4, "n-monthly": 2, "even": 1, "uneven": 1, "cuotas": 2, "limited": 2},
+}
+
+CASES = {
+    "small": {"accounts": 3, "transactions": 100, "years": 1, "months": 0, "mix": "mixed"},
+    "medium": {"accounts": 10, "transactions": 1500, "years": 5, "months": 0, "mix": "mixed"},
+    "large": {"accounts": 20, "transactions": 30000, "years": 10, "months": 0, "mix": "mixed"},
+}
+
+# Months before the current one in which generated transactions may start
+DEFAULT_PAST_MONTHS = 12
+
+
+def _cuotas(rnd):
+    total_quotes = rnd.choice([3, 6, 12, 18])
+    return None, None, "{0}/{1}".format(rnd.randint(1, total_quotes), total_quotes)
+
+
+def generate_input(filename, accounts, transactions, mix="mixed", seed=1, past_months=DEFAULT_PAST_MONTHS):
+    """
+    Writes a balance workbook with the given number of accounts and transactions. The transactions start from
+    past_months before until half a year after today, with their kind of recurrence drawn from the mix. The first
+    versions of the export fail on transactions starting before the current month, past_months=0 leaves them out.
+    """
+    rnd = random.Random(seed)
+    kinds = sorted(MIXES[mix].items())
+    today = date.today()
+
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(TransactionWorkbook.BANKS_COLS)
+    names = []
+    for account_nr in range(accounts):
+        names.append("Bank {0}".format(account_nr + 1))
+        sheet.append([names[-1], rnd.choice(["AR$", "US$"]), round(rnd.uniform(-1000, 50000), 2),
+                      datetime(today.year, today.month, rnd.randint(1, 28))])
+
+    sheet.append([])
+    sheet.append(TransactionWorkbook.BALANCES_COLS)
+    for transaction_nr in range(transactions):
+        kind = _weighted_choice(rnd, kinds)
+        interval, reps, quotes = RECURRENCES[kind](rnd)
+        start_month = monthcalendar.date_month(today) + rnd.randint(-past_months, 6)
+        year, month = monthcalendar.ordinal_year_month(start_month)
+        sheet.append([rnd.choice(names), "Transaction {0}".format(transaction_nr + 1), kind, "AR$",
+                      round(rnd.uniform(-2000, 2000), 2), datetime(year, month, rnd.randint(1, 28)), interval, reps,
+                      quotes])
+
+    workbook.save(filename)
+
+
+def _weighted_choice(rnd, weighted):
+    position = rnd.uniform(0, sum(weight for _, weight in weighted))
+    for value, weight in weighted:
+        position -= weight
+        if position <= 0:
+            break
+    return value
+
+
+def run_case(case):
+    """
+    Runs a single case in this process and returns the time of each phase, by the path of its span, and the peak
+    memory.
+    """
+    instrumentation.enable(report_file=None)
+
+    folder = tempfile.mkdtemp(prefix="budgetcalc-benchmark-")
+    try:
+        start = time.time()
+        calculator = BudgetCalc()
+        calculator.read_input(case["input"])
+        calculator.save_prognosis(folder, years=case["years"], months=case["months"],
+                                  write_only=case["write_only"], formulas=case["formulas"], workers=case["workers"])
+        total = time.time() - start
+        output_bytes = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+    finally:
+        shutil.rmtree(folder)
+
+    report = instrumentation.report()
+    return {"total": total, "phases": dict((path, span["seconds"]) for path, span in report["spans"].items()),
+            "output_bytes": output_bytes, "peak_rss_kb": report["peak_rss_kb"]}
+
+
+def benchmark(name, case, repeat=3):
+    """
+    Runs a case repeat times, each in a new process, and keeps the fastest time of every phase.
+    """
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--run", json.dumps(case)])
+        runs.append(json.loads(output.splitlines()[-1]))
+
+    phases = dict((phase, min(run["phases"][phase] for run in runs if phase in run["phases"]))
+                  for phase in set(phase for run in runs for phase in run["phases"]))
+    result = dict(case, name=name, total=min(run["total"] for run in runs), phases=phases,
+                  output_bytes=runs[-1]["output_bytes"], peak_rss_kb=max(run["peak_rss_kb"] for run in runs))
+    del result["input"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reading balance workbooks and saving prognoses.")
+    parser.add_argument("--cases", default="small,medium",
+                        help="comma separated cases out of {0} (default: %(default)s)".format(", ".join(sorted(CASES))))
+    parser.add_argument("--accounts", type=int, help="run a custom case with this number of accounts")
+    parser.add_argument("--transactions", type=int, default=1000, help="transactions of the custom case")
+    parser.add_argument("--years", type=int, default=1, help="years of the custom case")
+    parser.add_argument("--months", type=int, default=0, help="months of the custom case")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="mixed", help="recurrences of the custom case")
+    parser.add_argument("--write-only", action="store_true", help="stream the prognoses")
+    parser.add_argument("--formulas", action="store_true", help="calculate the balances with formulas")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes planning the accounts")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every case, the fastest counts")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated inputs")
+    parser.add_argument("--past-months", type=int, default=DEFAULT_PAST_MONTHS,
+                        help="months before the current one in which transactions may start; 0 to benchmark the "
+                             "first versions of the export (default: %(default)s)")
+    parser.add_argument("--output", help="file to write the results to, instead of the standard output")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print json.dumps(run_case(json.loads(args.run)))
+        return
+
+    if args.accounts:
+        cases = [("custom", {"accounts": args.accounts, "transactions": args.transactions, "years": args.years,
+                             "months": args.months, "mix": args.mix})]
+    else:
+        cases = [(name, CASES[name]) for name in args.cases.split(",")]
+
+    folder = tempfile.mkdtemp(prefix="budgetcalc-inputs-")
+    try:
+        results = []
+        for name, case in cases:
+            filename = os.path.join(folder, name + ".xlsx")
+            generate_input(filename, case["accounts"], case["transactions"], mix=case["mix"], seed=args.seed,
+                           past_months=args.past_months)
+            case = dict(case, input=filename, write_only=args.write_only, formulas=args.formulas,
+                        workers=args.workers, seed=args.seed, past_months=args.past_months)
+            results.append(benchmark(name, case, repeat=args.repeat))
+    finally:
+        shutil.rmtree(folder)
+
+    report = {"python": platform.python_version(), "openpyxl": openpyxl.__version__,
+              "machine": platform.machine(), "date": date.today().isoformat(), "cases": results}
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
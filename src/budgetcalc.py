@@ -2,15 +2,82 @@
  Created by waldo on 12/22/16
 """
 
+import os
+import re
 import sys
+import csv
+import errno
+import codecs
+import shutil
 import sqlite3
-import calendar
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+from collections import namedtuple, OrderedDict
 from openpyxl import Workbook, load_workbook
-from openpyxl.styles import Font, PatternFill, Alignment
-from dateutil import rrule
-from dateutil.relativedelta import relativedelta
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+from openpyxl.styles import Font, PatternFill, Alignment, NamedStyle
+from openpyxl.styles.fonts import DEFAULT_FONT
 from datetime import date, datetime
 
+import rowexport
+import recurrence
+import incremental
+import monthcalendar
+import instrumentation
+from forecast import Forecast
+from inputcache import InputCache, DEFAULT_DIRECTORY
+from incremental import PrognosisStates
+
+# Kinds of planned rows: the current balance, transactions on or after the balance date and the ones before it.
+ROW_CURRENT = 0
+ROW_ACTIVE = 1
+ROW_PRE = 2
+
+# Version of the parsed input in the database. Change it whenever _load_db stores something different, so cached
+# parses of older versions are not used.
+PARSER_VERSION = 5
+
+# Prefix of the named styles registered in the prognosis, keeping them apart from the built-in ones.
+STYLE_PREFIX = "Budget "
+
+# Decimal marks of the numbers in a text input. The other one separates their thousands.
+DECIMAL_MARKS = (".", ",")
+
+# An account of the input, with its position (from 1) in the accounts section.
+Account = namedtuple("Account", ["name", "currency", "balance", "date", "row"])
+
+
+class Transaction(object):
+    """
+    A transaction of the input, with its interval, repetitions and quotes (cuotas) parsed once when the input is
+    loaded. Without quotes, quote and total_quotes are None.
+    """
+
+    __slots__ = ("bank", "description", "subsection", "currency", "amount", "date", "interval_kind", "interval",
+                 "step", "repetitions", "quote", "total_quotes")
+
+    def __init__(self, bank, description, subsection, currency, amount, start_date, interval_kind, interval, step,
+                 repetitions, quote, total_quotes):
+        self.bank = bank
+        self.description = description
+        self.subsection = subsection
+        self.currency = currency
+        self.amount = amount
+        self.date = start_date
+        self.interval_kind = interval_kind
+        self.interval = interval
+        self.step = step
+        self.repetitions = repetitions
+        self.quote = quote
+        self.total_quotes = total_quotes
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
 COLUMN_ADD_FACTOR = 10
 COLUMN_MUL_FACTOR = 1.3
 balance_file = '/media/waldo/DATA-SHARE/Code/BudgetCalc/test/balance.xlsx'
@@ -18,43 +85,293 @@ prognosis_file = '/media/waldo/DATA-SHARE/Code/BudgetCalc/test/prognosis.xlsx'
 
 
 class BudgetCalc(object):
-    def __init__(self):
+    def __init__(self, cache=None, states=None):
         self.calcbook = TransactionWorkbook()
+        self.cache = cache
+        self.states = states
+
+    def read_input(self, filename, encoding=None, decimal_mark="."):
+        with instrumentation.span("read"):
+            self.calcbook.load(filename, cache=self.cache, encoding=encoding, decimal_mark=decimal_mark)
+
+    def save_prognosis(self, folder, years=1, months=0, write_only=False, formulas=False, workers=1, tag=None,
+                       exclusive=False, summary=False, output_format="xlsx", per_month=False):
+        """
+        Saves the prognosis in the folder and returns its filename. A tag is added to the filename to tell the
+        prognoses of different inputs apart. An exclusive save never replaces an existing file, but numbers the new
+        one instead.
+
+        With states, the prognosis builds on the one saved before in the same folder with the same horizon and tag,
+        only writing the month sheets that changed since. Exclusive saves always write a new prognosis in full.
+
+        The csv and jsonl formats save the rows of the prognosis instead of a workbook (see rowexport), with
+        per_month every month in a file of its own in a folder named like the prognosis. The workbook options do
+        not apply to them.
+        """
+        rows = output_format != "xlsx"
+        if rows:
+            rowexport.check_format(output_format)
+        extension = "" if rows and per_month else "." + output_format
+        filename = self._compose_filename(folder, years, months, tag=tag, extension=extension)
+        if exclusive:
+            filename = self._reserve_filename(filename, directory=rows and per_month)
+
+        previous = None
+        if self.states is not None and not exclusive and not rows:
+            key = self.states.key(folder, years, months, tag=tag)
+            previous = self.states.load(key)
 
-    def read_input(self, filename):
-        self.calcbook.load(filename)
-        pass
+        try:
+            with instrumentation.span("export"):
+                if rows:
+                    self.calcbook.export_rows(filename, years, months, output_format, per_month=per_month,
+                                              workers=workers)
+                else:
+                    state = self.calcbook.export(filename, years, months, write_only=write_only, formulas=formulas,
+                                                 workers=workers, previous=previous, summary=summary)
+        except Exception:
+            if exclusive:
+                if os.path.isdir(filename):
+                    shutil.rmtree(filename)
+                else:
+                    os.remove(filename)
+            raise
 
-    def save_prognosis(self, folder, years=1, months=0):
-        filename = self._compose_filename(folder, years, months)
-        self.calcbook.export(filename, years, months)
+        if previous is not None:
+            self.states.store(key, filename, state)
+
+        return filename
 
     @staticmethod
-    def _compose_filename(folder, years, months):
+    def _compose_filename(folder, years, months, tag=None, extension=".xlsx"):
         now = date.today()
-        then = now + relativedelta(years=+years, months=+months)
+        first_month = monthcalendar.date_month(now)
 
-        now_str = "{0}{1}".format(calendar.month_name[now.month][:3], now.year)
-        then_str = "{0}{1}".format(calendar.month_name[then.month][:3], then.year)
+        now_str = monthcalendar.short_month_title(first_month)
+        then_str = monthcalendar.short_month_title(first_month + years * 12 + months)
+        tag_str = "_{0}".format(tag) if tag else ""
 
-        filename = "{0}/{1}_Budget_{2}-{3}.xlsx".format(folder, str(now).translate(None, '-'), now_str, then_str)
+        filename = "{0}/{1}_Budget_{2}-{3}{4}{5}".format(folder, str(now).translate(None, '-'), now_str, then_str,
+                                                         tag_str, extension)
         return filename
 
+    @staticmethod
+    def _reserve_filename(filename, directory=False):
+        # Creating the file (or folder) fails if it exists, also when another process creates it at the same time.
+        base, extension = (filename, "") if directory else os.path.splitext(filename)
+        number = 1
+        while True:
+            try:
+                if directory:
+                    os.mkdir(filename)
+                else:
+                    os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+                return filename
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+            number += 1
+            filename = "{0} ({1}){2}".format(base, number, extension)
+
 
 class BudgetWorkbook(object):
+    # Inputs read as text, by extension, with the delimiter of their columns
+    TEXT_DELIMITERS = {".csv": ",", ".tsv": "\t", ".tab": "\t"}
+
+    # Encoding of text inputs unless given: UTF-8, with or without the byte order mark spreadsheet programs write
+    TEXT_ENCODING = "utf-8-sig"
+
     def __init__(self):
         self.workbook = Workbook()
         self.current_sheet = self.workbook.active
         self.num_rows = 0
         self.num_cols = 0
-
-    def load(self, filename):
-        self.workbook = load_workbook(filename=filename, data_only=True)
-        self.workbook.guess_types = True
+        self.text_file = None
+        self.delimiter = None
+        self.encoding = self.TEXT_ENCODING
+
+    def load(self, filename, encoding=None):
+        delimiter = self.TEXT_DELIMITERS.get(os.path.splitext(filename)[1].lower())
+        if delimiter is not None:
+            # A CSV or TSV export of the sheet is read line by line with the csv module, without openpyxl.
+            self.encoding = codecs.lookup(encoding or self.TEXT_ENCODING).name
+            self.text_file = open(filename, "rb")
+            self.delimiter = delimiter
+            return
+
+        # The input is only read from top to bottom, so the sheet is streamed rather than kept in memory.
+        self.workbook = load_workbook(filename=filename, read_only=True, data_only=True)
         self.current_sheet = self.workbook.active
         self.num_rows = self.current_sheet.max_row
         self.num_cols = self.current_sheet.max_column
 
+    def iter_rows(self, max_col):
+        """
+        The values of the rows of the input from the top, max_col of them per row. Empty cells are None. The cells of
+        a text input are all text.
+        """
+        if self.text_file is None:
+            for row in self.current_sheet.iter_rows(min_row=1, max_col=max_col):
+                # A row element without cells, as written for a formatted blank row, can come as an empty tuple.
+                values = [cell.value for cell in row]
+                yield values + [None] * (max_col - len(values))
+            return
+
+        for row_number, row in enumerate(csv.reader(self.text_file, delimiter=self.delimiter), 1):
+            try:
+                values = [value.decode(self.encoding) if value != "" else None for value in row[:max_col]]
+            except UnicodeDecodeError:
+                raise ValueError("Row {0} is not {1} text, give the encoding of the input (like cp1252)".format(
+                    row_number, self.encoding))
+            yield values + [None] * (max_col - len(values))
+
+    def close(self):
+        if self.text_file is not None:
+            self.text_file.close()
+            self.text_file = None
+            return
+
+        # A read-only workbook keeps the input file open until it is closed.
+        self.workbook.close()
+
+
+class AccountPlan(object):
+    """
+    The occurrences of one account within the prognosis, ordered by month, from which the rows of each month sheet
+    are built only when that sheet is written.
+    """
+
+    def __init__(self, name, currency, balance, balance_date, column, first_month, num_months, transactions,
+                 transaction, sequence, month_index, day):
+        self.name = name
+        self.currency = currency
+        self.balance = balance
+        self.date = balance_date
+        self.column = column
+        self.first_month = first_month
+        self.balance_month = monthcalendar.date_month(balance_date) - first_month
+        self.transactions = transactions
+        self.transaction = transaction
+        self.sequence = sequence
+        self.day = day
+        self.month_bounds = np.searchsorted(month_index, np.arange(num_months + 1)).tolist()
+        self.connected = False
+        self.links = dict()
+        self.rows = None
+
+        # The current balance goes before the first transaction on or after the balance date. Only those count for
+        # the balance, the ones before it are shown greyed out.
+        self.current_position = None
+        if self.balance_in_range:
+            first, last = self.month_bounds[self.balance_month:self.balance_month + 2]
+            self.current_position = int(np.searchsorted(day[first:last] >= balance_date.day, True))
+        self.active = (month_index > self.balance_month) | \
+                      ((month_index == self.balance_month) & (day >= balance_date.day))
+
+        self.balances = self._running_balances(month_index)
+
+    @property
+    def balance_in_range(self):
+        return 0 <= self.balance_month < len(self.month_bounds) - 1
+
+    def _running_balances(self, month_index):
+        # The balance after every occurrence, added up in the same order as the balance formulas do.
+        contributions = np.where(self.active, self.amounts()[self.transaction], 0.0)
+
+        if self.balance_in_range:
+            return np.cumsum(np.concatenate(([self._number(self.balance)], contributions)))[1:]
+
+        # Without a current balance the formulas start from nothing in every sheet.
+        balances = np.cumsum(contributions)
+        month_start = np.concatenate(([0.0], balances))[np.asarray(self.month_bounds[:-1])[month_index]]
+        return balances - month_start
+
+    @staticmethod
+    def _number(value):
+        # Like a SUM formula, anything that is not a number counts as zero.
+        return value if isinstance(value, (int, long, float)) else 0
+
+    def amounts(self):
+        # The amount of every transaction of the account, as the balances count it.
+        return np.array([self._number(transaction.amount) for transaction in self.transactions], dtype=np.float64)
+
+    def month_indexes(self):
+        # The index of the month of every occurrence.
+        return np.repeat(np.arange(len(self.month_bounds) - 1), np.diff(self.month_bounds))
+
+    def active_days(self, month_starts):
+        """
+        The day ordinals of the occurrences counting for the balance, given the day ordinals of the first days of the
+        months.
+        """
+        return (month_starts[self.month_indexes()] + self.day - 1)[self.active]
+
+    def carried_balance(self, month_index):
+        # The balance at the start of a month, i.e. after the last occurrence before it.
+        previous = self.month_bounds[month_index] - 1
+        return self.balances[previous] if previous >= 0 else self._number(self.balance)
+
+    def month_rows(self, month_index):
+        if self.rows is not None:
+            return self.rows[month_index]
+
+        first, last = self.month_bounds[month_index:month_index + 2]
+        year, month_num = monthcalendar.ordinal_year_month(self.first_month + month_index)
+        current_position = self.current_position if month_index == self.balance_month else None
+
+        rows = []
+        for position, (transaction_nr, month_nr, day, active, balance) in enumerate(zip(
+                self.transaction[first:last].tolist(), self.sequence[first:last].tolist(),
+                self.day[first:last].tolist(), self.active[first:last].tolist(), self.balances[first:last].tolist())):
+            if position == current_position:
+                rows.append(self.current_balance_row())
+
+            transaction = self.transactions[transaction_nr]
+            kind, balance = (ROW_ACTIVE, balance) if active else (ROW_PRE, None)
+            rows.append((kind, TransactionWorkbook._compose_description(month_nr, transaction),
+                         transaction.subsection, transaction.amount, date(year, month_num, day), balance))
+
+        if current_position == last - first:
+            rows.append(self.current_balance_row())
+
+        return rows
+
+    def build_rows(self):
+        # Build the rows of all months now rather than when each sheet is written.
+        self.rows = [self.month_rows(month_index) for month_index in range(len(self.month_bounds) - 1)]
+
+    def row_count(self, month_index):
+        count = self.month_bounds[month_index + 1] - self.month_bounds[month_index]
+        return count + 1 if month_index == self.balance_month else count
+
+    def current_balance_row(self):
+        return ROW_CURRENT, "CURRENT BALANCE", "", "", self.date, self.balance
+
+
+class ColumnWidths(object):
+    """
+    The longest text written to each column of a sheet, tracked while its cells are written, from which the
+    widths of the columns are set without going over the sheet again.
+    """
+
+    def __init__(self, lengths=None):
+        self.lengths = dict(lengths or {})
+
+    def track(self, column, value):
+        # Only text counts. Formulas display a number, and numbers and dates fit in the margin of the widths.
+        length = len(value) if isinstance(value, basestring) and not value.startswith("=") else 0
+        if length >= self.lengths.get(column, 0):
+            self.lengths[column] = length
+
+    def copy(self):
+        return ColumnWidths(self.lengths)
+
+    def apply(self, sheet, add_factor=0, mul_factor=1.0):
+        # Columns left empty between the accounts get the minimum width.
+        for column in range(1, max(self.lengths or [0]) + 1):
+            sheet.column_dimensions[get_column_letter(column)].width = \
+                (self.lengths.get(column, 0) + mul_factor) + add_factor
+
 
 class TransactionWorkbook(BudgetWorkbook):
     # Input columns
@@ -65,420 +382,665 @@ class TransactionWorkbook(BudgetWorkbook):
     # Output columns
     ACCOUNTS_COLS = ["Bank", "Balance at end of month"]
     TRANSACTIONS_COLS = ["Description", "Subsection", "Amount", "Date", "Balance after transaction"]
+    SUMMARY_TITLE = "Summary"
 
     def __init__(self):
         super(TransactionWorkbook, self).__init__()
         self.db_connection = None
         self.db_cursor = None
+        self.account_rows = []
+        self.accounts = []
+        self._accounts_current = None
+        self._accounts_day = None
         self.accounts_section = []
         self.transaction_section = []
+        self.number_pattern = self._number_pattern(".")
         self.header_font = Font(name="Calibri", size=11, bold=True)
         self.text_font = Font(name="Calibri", size=11)
         self.grey_font = Font(name="Calibri", size=11, color="808080")
-        self.month_to_num = {name: num for num, name in enumerate(calendar.month_abbr)}
+
+        justify = Alignment(horizontal="justify")
+        no_fill = PatternFill("none")
+        grey_fill = PatternFill("solid", fgColor="DDDDDD")
+
+        # The attributes of every kind of cell. Each is registered once per workbook as a named style, which cells
+        # then refer to by name.
+        self.cell_styles = {
+            "title": {"font": Font(name="Calibri", size=14, bold=True), "alignment": justify},
+            "header": {"font": self.header_font},
+            "na": {"font": self.grey_font, "alignment": justify},
+            "current": {"font": self.header_font, "number_format": "General", "alignment": justify},
+            "current-empty": {"alignment": justify},
+            "current-date": {"font": self.header_font, "number_format": 'dd-mm-yyyy', "alignment": justify},
+            "text": {"fill": no_fill, "font": self.text_font, "number_format": "General", "alignment": justify},
+            "date": {"fill": no_fill, "font": self.text_font, "number_format": 'dd-mm-yyyy', "alignment": justify},
+            "pre-text": {"fill": grey_fill, "font": self.grey_font, "number_format": "General",
+                         "alignment": justify},
+            "pre-date": {"fill": grey_fill, "font": self.grey_font, "number_format": 'dd-mm-yyyy',
+                         "alignment": justify},
+            "pre-balance": {"fill": grey_fill, "alignment": justify},
+        }
+
+        # The kinds of cells holding an amount, which get a style per currency with its amount format (see
+        # _currency_style).
+        self.currency_styles = {
+            "amount": {"fill": no_fill, "font": self.text_font, "alignment": justify},
+            "balance": {"fill": no_fill, "font": self.grey_font, "alignment": justify},
+            "pre-amount": {"fill": grey_fill, "font": self.grey_font, "alignment": justify},
+            "current-balance": {"font": self.header_font, "alignment": justify},
+            "summary-balance": {"font": self.text_font, "alignment": justify},
+        }
 
     @property
     def accounts_current(self):
-        start_row = self._find_row(self.BANKS_COLS) + 1
-
-        balances = dict()
-        for index, row in enumerate(self.current_sheet.iter_rows(min_row=start_row,
-                                                                 max_col=len(self.BANKS_COLS),
-                                                                 max_row=self.num_rows)):
-            account_name = row[0].value
-            if account_name is not None:
-                balance_date = row[3].value
-
-                # If the balance date month is in the past, this account is not processed.
-                if relativedelta(balance_date, date.today()).months >= 0:
-                    currency = row[1].value
-                    balance = row[2].value
-                    balances[account_name] = (currency, balance, balance_date, index + 1)
+        # The accounts to process by name, in the order of the input. Only computed once per loaded input and day,
+        # a loaded input kept by the server outlives the day.
+        day = date.today()
+        if self._accounts_current is None or self._accounts_day != day:
+            balances = dict()
+            today = datetime.combine(day, datetime.min.time())
+            for account in self.accounts:
+                # If the balance date month is in the past, this account is not processed. Only the months part of
+                # the time since the balance date counts, not the whole years.
+                months = monthcalendar.months_between(account.date, today)
+                if months >= 0 or months % 12 == 0:
+                    balances[account.name] = account
+
+            self._accounts_current = OrderedDict((account.name, account)
+                                                 for account in sorted(balances.values(), key=lambda ac: ac.row))
+            self._accounts_day = day
+
+        return self._accounts_current
+
+    def load(self, filename, cache=None, encoding=None, decimal_mark="."):
+        """
+        Loads the input. The encoding and decimal mark only apply to text inputs (CSV or TSV), which are UTF-8 with
+        a decimal point unless given.
+        """
+        if decimal_mark not in DECIMAL_MARKS:
+            raise ValueError("Unknown decimal mark {0!r}, should be one of {1}".format(decimal_mark,
+                                                                                    " ".join(DECIMAL_MARKS)))
+        self.number_pattern = self._number_pattern(decimal_mark)
+
+        # A cached parse of the same input skips reading the workbook altogether.
+        with instrumentation.span("cache"):
+            key = cache.key(filename, options=(encoding, decimal_mark)) if cache is not None else None
+            restored = key is not None and self._restore_db(cache, key)
+
+        if not restored:
+            with instrumentation.span("open"):
+                super(TransactionWorkbook, self).load(filename, encoding=encoding)
+            with instrumentation.span("parse"):
+                # A bad row must not leave the input open in a long-running process.
+                try:
+                    self._load_db()
+                finally:
+                    self.close()
+
+            if key is not None:
+                with instrumentation.span("cache"):
+                    cache.store(key, self.db_connection)
+
+        self._index_accounts()
+
+    def _index_accounts(self):
+        self.accounts = [Account(*(row + (index + 1,))) for index, row in enumerate(self.account_rows)]
+        self._accounts_current = None
+
+    def export(self, filename, years, months, write_only=False, formulas=False, workers=1, previous=None,
+               summary=False):
+        """
+        Saves the prognosis as filename. Given the state of an earlier export, previous, the month sheets that did not
+        change since are copied from its output instead of written again, and the state of this export is returned.
+        An empty previous state writes all sheets. With summary, a last sheet lists the balance of every account at
+        the end of every month.
+        """
+        # Plan the rows of every account in every month before anything is written.
+        sorted_accounts, month_ordinals, plans = self.plan(years, months, workers=workers)
+        with instrumentation.span("connect"):
+            for plan in plans:
+                if plan.connected:
+                    self._connect_sheet_formulae(plan, len(month_ordinals))
+        forecast = Forecast.from_plans(month_ordinals, plans) if summary else None
+
+        state, reused, shared_strings = None, set(), None
+        if previous is not None:
+            with instrumentation.span("compare"):
+                state = self._prognosis_state(sorted_accounts, month_ordinals, plans, write_only, formulas, summary,
+                                              previous)
+                reused = incremental.unchanged_months(previous, state, len(month_ordinals))
+            instrumentation.count("sheets reused", len(reused))
+
+        # Only the changed sheets are written, to a workbook that the reused sheets are spliced into afterwards.
+        output = filename
+        if reused:
+            shared_strings = incremental.read_shared_strings(previous["output"])
+            output = incremental.temporary_output(filename)
+
+        try:
+            if write_only:
+                with instrumentation.span("stream"):
+                    self._stream_workbook(output, sorted_accounts, month_ordinals, plans, formulas, reused=reused,
+                                          shared_strings=shared_strings, forecast=forecast)
             else:
-                break
-
-        return balances
-
-    def load(self, filename):
-        super(TransactionWorkbook, self).load(filename)
-        self._load_db()
-
-    def export(self, filename, years, months):
-        # Sort the accounts according to their order in the source sheet
-        sorted_items = sorted(self.accounts_current.items(), key=lambda ac: ac[1][3])
-        sorted_accounts = [item[0] for item in sorted_items]
-
-        # Prepare a framework / the headers in the workbook.
-        # TODO: we already have to start the bank accounts before we do the print of frame
-        transactions_book = self._print_frame(sorted_accounts, self.ACCOUNTS_COLS, self.TRANSACTIONS_COLS, years,
-                                              months)
-
-        for bank_nr, account in enumerate(sorted_accounts):
-            account_date = self.accounts_current[account][2].date()
-            account_balance = self.accounts_current[account][1]
-            account_currency = self.accounts_current[account][0]
-
-            # Retrieve the entries from database.
-            # Sort the entries on the appropriate columns. Unlimited repetitions first.
-            value = (account,)
-            transactions = self.db_cursor.execute('SELECT * FROM transactions WHERE bank=? '
-                                                  'ORDER BY date ASC, reps DESC', value)
-
-            # Initialize a dictionary where the keys are the sheet names, and the values the current cell coordinates.
-            cell_pointer = self.transaction_section[0][:]  # Make a shallow copy
-            cell_pointer[0] += bank_nr * (len(self.TRANSACTIONS_COLS) + 1)
-            cell_pointer[1] += 3
-            sheet_pointers = {key: cell_pointer[:] for key in transactions_book.sheetnames}
-
-            current_balance_inserted = False
-            transactions_empty = True
-
-            # Sort the transactions by DAY of the month, ascending, irrespective of the actual month.
-            sorted_transactions = sorted(transactions, key=lambda tr: tr[5][-11:-9])
-            for index, transaction in enumerate(sorted_transactions):
-                transactions_empty = False
-
-                # For each entry calculate the months applicable.
-                num_months_in_sheet = len(transactions_book.sheetnames)
-                start_month = datetime.strptime(transaction[5],
-                                                "%Y-%m-%d %H:%M:%S")  # TODO - do we really need the hour etc.
-                                                                      # TODO - gives an error if we have for instance a non-existing date like 30/06/2017
-                between_start_and_now = 12 * (start_month.year - datetime.now().year) + \
-                                        (start_month.month - datetime.now().month)
-                num_months_in_range = num_months_in_sheet - between_start_and_now
-                applicable_months = self._calc_applicable_months(transaction, num_months_in_range)
-
-                date_time_value = datetime.strptime(transaction[5], "%Y-%m-%d %H:%M:%S")
-                transaction_date = date_time_value.date()
-
-                # For each necessary month make an entry.
-                for month_nr, month in enumerate(applicable_months):
-                    # Initializations
-                    day_num = transaction_date.day
-                    month_abbr = month[:3]
-                    month_num = self.month_to_num[month_abbr]
-                    year = int(month[-4:])
-
-                    while True:
-                        try:
-                            work_date = transaction_date.replace(day=day_num, month=month_num, year=year)
-                            break
-                        except ValueError:
-                            # We end up here when the day does not exist in the month. I.e. 30 Feb.
-                            day_num -= 1
-
-                    cell_pointer = sheet_pointers[month]
-                    month_sheet = transactions_book.get_sheet_by_name(month)
-
-                    # Write the date. We do this first, because we might need to insert the current balance first.
-                    if account_date.month == month_num and account_date.year == year and \
-                                    work_date >= account_date and not current_balance_inserted:
-                        # TODO: DRY
-                        # Description
-                        cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0])
-                        cell.value = "CURRENT BALANCE"
-                        cell.font = self.   header_font
-                        cell.number_format = "General"
-                        cell.alignment = Alignment(horizontal="justify")
-
-                        # Subsection and Amount should be empty
-                        cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 1)
-                        cell.value = ""
-                        cell.alignment = Alignment(horizontal="justify")
-                        cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 2)
-                        cell.value = ""
-                        cell.alignment = Alignment(horizontal="justify")
-
-                        # Date
-                        cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 3)
-                        cell.value = account_date
-                        cell.font = self.header_font
-                        cell.number_format = 'dd-mm-yyyy'
-                        cell.alignment = Alignment(horizontal="justify")
-
-                        # Balance
-                        cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 4)
-                        cell.value = account_balance
-                        cell.font = self.header_font
-                        cell.number_format = '#,###.00 [${0}];[RED]-#,###.00 [${0}]'.format(account_currency)
-                        cell.alignment = Alignment(horizontal="justify")
-
-                        current_balance_inserted = True
-                        cell_pointer[1] += 1
-                    if work_date >= account_date:
-                        fill_colour = PatternFill("none")
-                        current_font = self.text_font
-
-                        # Calculate and write the 'balance after transaction'
-                        cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 4)
-                        cell_prev_row = month_sheet.cell(row=cell_pointer[1] - 1, column=cell_pointer[0] + 4)
-                        cell_with_amount = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 2)
-                        cell.value = '=SUM({0},{1})'.format(cell_prev_row.coordinate, cell_with_amount.coordinate)
-                        cell.fill = fill_colour
-                        cell.number_format = '#,###.00 [$AR$];[RED]-#,###.00 [$AR$]'
-                        cell.font = self.grey_font
-                        cell.alignment = Alignment(horizontal="justify")
-                    else:
-                        # Else, the cell should be empty and filled with a grey background colour
-                        fill_colour = PatternFill("solid", fgColor="DDDDDD")
-                        current_font = self.grey_font
-                        cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 4)
-                        cell.fill = fill_colour
-                        cell.alignment = Alignment(horizontal="justify")
-
-                    # Write the date
-                    cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 3)
-                    cell.value = work_date
-                    cell.number_format = 'dd-mm-yyyy'
-                    cell.fill = fill_colour
-                    cell.font = current_font
-                    cell.alignment = Alignment(horizontal="justify")
-
-                    # Write the description
-                    cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0])
-                    cell.value = self._compose_description(month_nr, transaction)
-                    cell.number_format = "General"
-                    cell.fill = fill_colour
-                    cell.font = current_font
-                    cell.alignment = Alignment(horizontal="justify")
-
-                    # Write the subsection
-                    cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 1)
-                    cell.value = transaction[2]
-                    cell.number_format = "General"
-                    cell.fill = fill_colour
-                    cell.font = current_font
-                    cell.alignment = Alignment(horizontal="justify")
-
-                    # Write the amount
-                    cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 2)
-                    cell.value = transaction[4]
-                    cell.number_format = '#,###.00 [$AR$];[RED]-#,###.00 [$AR$]'
-                    cell.fill = fill_colour
-                    cell.font = current_font
-                    cell.alignment = Alignment(horizontal="justify")
-
-                    cell_pointer[1] += 1
+                # Prepare a framework / the headers in the workbook.
+                with instrumentation.span("frame"):
+                    transactions_book = self._print_frame(sorted_accounts, self.ACCOUNTS_COLS, self.TRANSACTIONS_COLS,
+                                                          month_ordinals, shared_strings=shared_strings)
+                with instrumentation.span("write"):
+                    self._write_cells(transactions_book, sorted_accounts, plans, formulas, reused=reused)
+                if forecast is not None:
+                    with instrumentation.span("summary"):
+                        self._write_summary(transactions_book, forecast)
+
+                with instrumentation.span("save"):
+                    transactions_book.save(output)
+
+            if reused:
+                with instrumentation.span("splice"):
+                    incremental.splice(previous["output"], output, filename, reused)
+        finally:
+            if output != filename and os.path.exists(output):
+                os.remove(output)
+
+        return state
+
+    def _prognosis_state(self, account_names, month_ordinals, plans, write_only, formulas, summary, previous):
+        # Anything that changes the place of the cells, or the output as a whole, is part of the layout. The summary
+        # comes after the month sheets and is always written again.
+        layout = incremental.fingerprint((month_ordinals[0], len(month_ordinals), write_only, formulas, summary,
+                                          account_names, [plan.name for plan in plans],
+                                          self._style_keys(account_names), self.transaction_section))
+
+        accounts = {}
+        previous_accounts = previous.get("accounts", {})
+        for plan in plans:
+            account = incremental.fingerprint((layout, plan.name, plan.currency, plan.balance, plan.date, plan.column,
+                                               [transaction.values() for transaction in plan.transactions]))
+
+            # The cells of an account that did not change are the same as before, so only changed accounts are
+            # gone over.
+            known = previous_accounts.get(plan.name)
+            if known is not None and known["fingerprint"] == account:
+                months = known["months"]
             else:
-                # All transactions were entered, but the balance is on a date greater than any transaction.
-                if not current_balance_inserted:
-                    sheet_title = "{0} {1}".format(calendar.month_name[account_date.month], account_date.year)
-
-                    try:
-                        cell_pointer = sheet_pointers[sheet_title]
-                        month_sheet = transactions_book.get_sheet_by_name(sheet_title)
-                    except Exception as e:
-                        print "Account balance date seems to be in the past."
-                        break
+                plan.build_rows()
+                months = [incremental.fingerprint(list(self._account_cells(plan, month_index, formulas)))
+                          for month_index in range(len(month_ordinals))]
+                instrumentation.count("accounts changed")
+            accounts[plan.name] = {"fingerprint": account, "months": months}
+
+        return {"layout": layout, "accounts": accounts}
+
+    def plan(self, years, months, workers=1):
+        """
+        Plans the accounts over a prognosis of the given years and months. Returns the names of the accounts in their
+        order in the source sheet, the month ordinals of the month sheets and the plans of the accounts.
+        """
+        sorted_accounts = list(self.accounts_current)
+        month_ordinals = self._prognosis_months(years, months)
+        self._reserve_sections(sorted_accounts)
+        with instrumentation.span("plan"):
+            plans = self._plan_accounts(sorted_accounts, month_ordinals, workers=workers)
+
+        return sorted_accounts, month_ordinals, plans
+
+    def forecast(self, years, months, workers=1):
+        """
+        The forecast balances of the accounts over a prognosis of the given years and months.
+        """
+        sorted_accounts, month_ordinals, plans = self.plan(years, months, workers=workers)
+        return Forecast.from_plans(month_ordinals, plans)
+
+    def export_rows(self, filename, years, months, output_format, per_month=False, workers=1):
+        """
+        Saves the rows of the prognosis as CSV or JSON Lines (see rowexport), with their balances as planned.
+        """
+        sorted_accounts, month_ordinals, plans = self.plan(years, months, workers=workers)
+        with instrumentation.span("rows"):
+            count = rowexport.save(filename, month_ordinals, plans, output_format, per_month=per_month)
+        instrumentation.count("rows written", count)
+
+    def _write_cells(self, transactions_book, account_names, plans, formulas, reused=()):
+        # Every sheet has the same frame, so its widths are only tracked once.
+        frame_widths = ColumnWidths()
+        for row, column, value, style in self._frame_cells(account_names, self.TRANSACTIONS_COLS):
+            frame_widths.track(column, value)
+
+        written = 0
+        for month_index, month_sheet in enumerate(transactions_book.worksheets):
+            if month_index in reused:
+                continue
 
-                    # TODO: DRY
-                    # Description
-                    cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0])
-                    cell.value = "CURRENT BALANCE"
-                    cell.font = self.header_font
-                    cell.number_format = "General"
-                    cell.alignment = Alignment(horizontal="justify")
-
-                    # Subsection and Amount should be empty
-                    cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 1)
-                    cell.value = ""
-                    cell.alignment = Alignment(horizontal="justify")
-                    cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 2)
-                    cell.value = ""
-                    cell.alignment = Alignment(horizontal="justify")
-
-                    # Date
-                    cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 3)
-                    cell.value = account_date
-                    cell.font = self.header_font
-                    cell.number_format = 'dd-mm-yyyy'
-                    cell.alignment = Alignment(horizontal="justify")
-
-                    # Balance
-                    cell = month_sheet.cell(row=cell_pointer[1], column=cell_pointer[0] + 4)
-                    cell.value = account_balance
-                    cell.font = self.header_font
-                    cell.number_format = '#,###.00 [${0}];[RED]-#,###.00 [${0}]'.format(account_currency)
-                    cell.alignment = Alignment(horizontal="justify")
-
-                    cell_pointer[1] += 1
-
-            if not transactions_empty:
-                self._connect_sheet_formulae(account, transactions_book, sheet_pointers)
-
-        self._autosize_columns(transactions_book, add_factor=COLUMN_ADD_FACTOR, mul_factor=COLUMN_MUL_FACTOR)
-
-        transactions_book.save(filename)
-
-    def _compose_description(self, month_nr, transaction):
-        quote_suffix = ""
+            widths = frame_widths.copy()
+            for plan in plans:
+                for row, column, value, style in self._account_cells(plan, month_index, formulas):
+                    cell = month_sheet.cell(row=row, column=column)
+                    cell.value = value
+                    self._apply_style(cell, style)
+                    widths.track(column, value)
+                    written += 1
+
+            widths.apply(month_sheet, add_factor=COLUMN_ADD_FACTOR, mul_factor=COLUMN_MUL_FACTOR)
+
+        instrumentation.count("cells written", written)
+
+    def _write_summary(self, transactions_book, forecast):
+        summary_sheet = transactions_book.create_sheet(title=self.SUMMARY_TITLE)
+        widths = ColumnWidths()
+        for row, column, value, style in self._summary_cells(forecast):
+            cell = summary_sheet.cell(row=row, column=column)
+            cell.value = value
+            self._apply_style(cell, style)
+            widths.track(column, value)
+
+        widths.apply(summary_sheet, add_factor=COLUMN_ADD_FACTOR, mul_factor=COLUMN_MUL_FACTOR)
+
+    def _summary_cells(self, forecast):
+        # The balances are values taken from the forecast, not formulas referring to the month sheets.
+        start_column, start_row = self.accounts_section[0]
+        yield start_row, start_column, self.ACCOUNTS_COLS[1], "title"
+
+        yield start_row + 2, start_column, self.ACCOUNTS_COLS[0], "header"
+        for month_index, ordinal in enumerate(forecast.month_ordinals):
+            yield start_row + 2, start_column + 1 + month_index, monthcalendar.month_title(ordinal), "header"
+
+        month_ends = forecast.month_end_balances().tolist()
+        for account_nr, account in enumerate(forecast.accounts.values()):
+            row = start_row + 3 + account_nr
+            yield row, start_column, account.name, "text"
+
+            style = self._currency_style("summary-balance", account.currency)
+            for month_index, balance in enumerate(month_ends[account_nr]):
+                # Months ending before the balance date have no known balance.
+                if np.isnan(balance):
+                    yield row, start_column + 1 + month_index, "N/A", "na"
+                else:
+                    yield row, start_column + 1 + month_index, balance, style
+
+    def _plan_accounts(self, sorted_accounts, month_ordinals, workers=1):
+        first_month = month_ordinals[0]
+        num_months = len(month_ordinals)
+
+        accounts = []
+        for bank_nr, name in enumerate(sorted_accounts):
+            account = self.accounts_current[name]
+            accounts.append((name, account.currency, account.balance, account.date.date(),
+                             self.transaction_section[0][0] + bank_nr * (len(self.TRANSACTIONS_COLS) + 1)))
+        with instrumentation.span("retrieve"):
+            account_transactions = self._retrieve_transactions(sorted_accounts)
+        instrumentation.count("transactions", sum(len(transactions) for transactions in account_transactions))
+
+        if workers > 1 and len(accounts) > 1:
+            # Every account is planned on its own, including its rows, in a worker process.
+            jobs = [([account], [transactions], first_month, num_months)
+                    for account, transactions in zip(accounts, account_transactions)]
+            pool = multiprocessing.Pool(min(workers, len(jobs)))
+            try:
+                plans = pool.map(_plan_account_job, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            plans = plan_accounts(accounts, account_transactions, first_month, num_months)
+
+        for index, plan in enumerate(plans):
+            # Without a sheet for the balance date there is no place for the current balance.
+            if not plan.balance_in_range:
+                # Not on stdout, where the scenarios and batch commands write their JSON.
+                print >> sys.stderr, "Account balance date seems to be in the past."
+                return plans[:index + 1]
+
+            plan.connected = len(plan.transactions) > 0
+
+        return plans
+
+    def _account_cells(self, plan, month_index, formulas):
+        first_row = self.transaction_section[0][1] + 3
+        column = plan.column
+        amount_column = get_column_letter(column + 2)
+        balance_column = get_column_letter(column + 4)
+        link = plan.links.get(month_index)
+        rows = plan.month_rows(month_index)
+        balance_style = self._currency_style("balance", plan.currency)
+        amount_styles = {"": self._currency_style("amount", plan.currency),
+                         "pre-": self._currency_style("pre-amount", plan.currency)}
+
+        if not rows:
+            # The dummy row of an empty month carries the balance over to the next month.
+            if link is not None:
+                if formulas:
+                    balance = self._link_formula(plan.first_month, link, balance_column, amount_column, first_row)
+                else:
+                    balance = plan.carried_balance(month_index)
+                yield first_row, column + 4, balance, balance_style
+            return
 
-        # If there are quotes, then incorporate the numbering in the description
-        quotes = transaction[8]
-        if quotes != "":
-            quote_num, total_quotes = [int(x) for x in quotes.split('/')]
-            quote_num += month_nr
-            quote_suffix = " ({0}/{1})".format(quote_num, total_quotes)
+        for offset, (kind, description, subsection, amount, work_date, balance) in enumerate(rows):
+            row = first_row + offset
+            if kind == ROW_CURRENT:
+                yield row, column, description, "current"
 
-        description = transaction[1] + quote_suffix
-        return description
+                # Subsection and Amount should be empty
+                yield row, column + 1, "", "current-empty"
+                yield row, column + 2, "", "current-empty"
 
-    def _autosize_columns(self, transactions_book, add_factor=0, mul_factor=1.0):
-        for sheet in transactions_book.worksheets:
-            for column in sheet.columns:
-                max_length = 0
-                for cell in column:
-                    try:  # Necessary to avoid error on empty cells
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(cell.value)
-                    except:
-                        pass
-
-                adjusted_width = (max_length + mul_factor) + add_factor
-                sheet.column_dimensions[cell.column].width = adjusted_width
-
-    def _connect_sheet_formulae(self, account, transactions_book, sheet_pointers):
-        # First determine the sheet to start connecting formulae
-        balance_date = self.accounts_current[account][2].date()
-        first_sheet_title = "{0} {1}".format(calendar.month_name[balance_date.month], balance_date.year)
-
-        start = False
-        for sheet in transactions_book.worksheets:
-            if sheet.title == first_sheet_title:
-                start = True
-                pointer = sheet_pointers[first_sheet_title]
-                prev_balance_cell = sheet.cell(row=pointer[1] - 1, column=pointer[0] + len(self.TRANSACTIONS_COLS) - 1)
+                yield row, column + 3, work_date, "current-date"
+                yield row, column + 4, balance, self._currency_style("current-balance", plan.currency)
                 continue
 
-            if start:
-                pointer = sheet_pointers[sheet.title]
-                amount_cell = sheet.cell(row=self.transaction_section[0][1] + 3,
-                                         column=pointer[0] + len(self.TRANSACTIONS_COLS) - 3)
+            if kind == ROW_ACTIVE:
+                # Write the 'balance after transaction', or a formula calculating it
+                if not formulas:
+                    pass
+                elif offset == 0 and link is not None:
+                    balance = self._link_formula(plan.first_month, link, balance_column, amount_column, row)
+                else:
+                    balance = '=SUM({0}{1},{2}{3})'.format(balance_column, row - 1, amount_column, row)
+                yield row, column + 4, balance, balance_style
+                prefix = ""
+            else:
+                # Else, the cell should be empty and filled with a grey background colour
+                yield row, column + 4, None, "pre-balance"
+                prefix = "pre-"
 
-                new_balance_cell = sheet.cell(row=self.transaction_section[0][1] + 3,
-                                              column=pointer[0] + len(self.TRANSACTIONS_COLS) - 1)
-                new_balance_cell.value = '=SUM(\'{0}\'!{1},{2})'.format(prev_balance_cell.parent.title,
-                                                                        prev_balance_cell.coordinate,
-                                                                        amount_cell.coordinate)
+            yield row, column + 3, work_date, prefix + "date"
+            yield row, column, description, prefix + "text"
+            yield row, column + 1, subsection, prefix + "text"
+            yield row, column + 2, amount, amount_styles[prefix]
 
-                new_balance_cell.number_format = '#,###.00 [$AR$];[RED]-#,###.00 [$AR$]'
-                new_balance_cell.font = self.grey_font
-                new_balance_cell.alignment = Alignment(horizontal="justify")
+    @staticmethod
+    def _link_formula(first_month, link, balance_column, amount_column, row):
+        month_index, balance_row = link
+        sheet_title = monthcalendar.month_title(first_month + month_index)
+        return '=SUM(\'{0}\'!{1}{2},{3}{4})'.format(sheet_title, balance_column, balance_row, amount_column, row)
 
-                pointer = sheet_pointers[sheet.title]
+    @staticmethod
+    def _amount_format(currency):
+        return '#,###.00 [${0}];[RED]-#,###.00 [${0}]'.format(currency)
+
+    def _currency_style(self, kind, currency):
+        key = "{0} {1}".format(kind, currency)
+        if key not in self.cell_styles:
+            self.cell_styles[key] = dict(self.currency_styles[kind], number_format=self._amount_format(currency))
+        return key
+
+    def _style_keys(self, account_names):
+        # Every account's currency has its own styles for the cells holding amounts.
+        accounts = self.accounts_current
+        for account_name in account_names:
+            for kind in self.currency_styles:
+                self._currency_style(kind, accounts[account_name].currency)
+        return sorted(self.cell_styles)
+
+    def _register_styles(self, workbook, account_names):
+        for key in self._style_keys(account_names):
+            attributes = self.cell_styles[key]
+            # Attributes left out keep the look of an unstyled cell.
+            style = NamedStyle(name=STYLE_PREFIX + key, font=DEFAULT_FONT)
+            for name, value in attributes.items():
+                setattr(style, name, value)
+            workbook.add_named_style(style)
+
+            # Cells refer to their style by its position in the workbook, which is otherwise given by the first
+            # cell using it. Fixing the order keeps the positions the same in every prognosis with the same styles.
+            workbook._cell_styles.add(style.as_tuple())
 
-                if pointer[1] > (self.transaction_section[0][1] + 3):
-                    adjust = 1
-                else:
-                    adjust = 0
+    @staticmethod
+    def _apply_style(cell, style):
+        cell.style = STYLE_PREFIX + style
+
+    def _stream_workbook(self, filename, account_names, month_ordinals, plans, formulas, reused=(),
+                         shared_strings=None, forecast=None):
+        output = Workbook(write_only=True)
+        self._register_styles(output, account_names)
+        if shared_strings is not None:
+            output.shared_strings = shared_strings
+
+        for month_index, ordinal in enumerate(month_ordinals):
+            month_sheet = output.create_sheet(title=monthcalendar.month_title(ordinal))
+            if month_index in reused:
+                continue
 
-                prev_balance_cell = sheet.cell(row=pointer[1] - adjust,
-                                               column=pointer[0] + len(self.TRANSACTIONS_COLS) - 1)
+            # Cells of the accounts take the place of the frame's dummies.
+            self._stream_sheet(month_sheet, itertools.chain(
+                self._frame_cells(account_names, self.TRANSACTIONS_COLS),
+                *[self._account_cells(plan, month_index, formulas) for plan in plans]))
+            instrumentation.count("sheets created")
+
+        if forecast is not None:
+            with instrumentation.span("summary"):
+                self._stream_sheet(output.create_sheet(title=self.SUMMARY_TITLE), self._summary_cells(forecast))
+
+        with instrumentation.span("save"):
+            output.save(filename)
+
+    def _stream_sheet(self, sheet, cells):
+        # Collect the cells of the sheet per row. A later cell takes the place of an earlier one.
+        sheet_rows = {}
+        widths = ColumnWidths()
+        for row, column, value, style in cells:
+            sheet_rows.setdefault(row, {})[column] = (value, style)
+            widths.track(column, value)
+
+        # A streamed sheet writes its columns before the first row, so their widths are set beforehand.
+        widths.apply(sheet, add_factor=COLUMN_ADD_FACTOR, mul_factor=COLUMN_MUL_FACTOR)
+
+        for row in range(1, max(sheet_rows) + 1 if sheet_rows else 1):
+            columns = sheet_rows.get(row, {})
+            line = [None] * max(columns or [0])
+            for column, (value, style) in columns.items():
+                cell = WriteOnlyCell(sheet, value=value)
+                self._apply_style(cell, style)
+                line[column - 1] = cell
+            sheet.append(line)
+
+        instrumentation.count("cells written", sum(len(columns) for columns in sheet_rows.values()))
 
-    def _calc_applicable_months(self, transaction, num_months):
-        applicable_months = []
-        next_date = datetime.strptime(transaction[5], "%Y-%m-%d %H:%M:%S")
+    @staticmethod
+    def _compose_description(month_nr, transaction):
+        quote_suffix = ""
 
-        num_reps = transaction[7]
+        # If there are quotes, then incorporate the numbering in the description
+        if transaction.total_quotes is not None:
+            quote_suffix = " ({0}/{1})".format(transaction.quote + month_nr, transaction.total_quotes)
 
-        # If the number of repetitions is not defined explicitly, check whether the quotes (#/#) can define them
-        try:
-            if num_reps == "":
-                quote_num, total_quotes = [int(x) for x in transaction[8].split('/')]
-                num_reps = (total_quotes - quote_num) + 1
-            else:
-                num_reps = int(num_reps)
-        except ValueError:
-            # The quotes field is not defined. Initialize the number of reps to the maximum possible.
-            num_reps, total_quotes = num_months, None
+        description = transaction.description + quote_suffix
+        return description
 
-        # Save the step interval. If the interval is an integer, cast it to int. If it is not an integer and the field
-        # is empty, set the interval to 1.
-        try:
-            interval = transaction[6]
-            interval = step = int(interval)
-        except ValueError as e:
-            if transaction[6] == "":
-                interval = step = 1
-            else:
-                step = 2
+    def _connect_sheet_formulae(self, plan, num_months):
+        # Start connecting formulae at the sheet of the balance date. The first balance of every next sheet
+        # continues from the last balance of the sheet before.
+        first_row = self.transaction_section[0][1] + 3
+        prev_month = plan.balance_month
+        prev_row = first_row + plan.row_count(plan.balance_month) - 1
 
-        # The first applicable month is always the month of the start date
-        applicable_months.append("{0} {1}".format(calendar.month_name[next_date.month], next_date.year))
-        num_reps -= 1
-        try:
-            num_months -= step
-            pass
-        except:
-            pass
+        for month_index in range(plan.balance_month + 1, num_months):
+            plan.links[month_index] = (prev_month, prev_row)
 
-        while num_reps > 0 and num_months > 0:
-            next_date, increment = self._incr_month(next_date, interval)
-            applicable_months.append("{0} {1}".format(calendar.month_name[next_date.month], next_date.year))
-            num_reps -= 1
-            num_months -= increment
+            # An empty month still has its dummy row, which carries the balance.
+            prev_month = month_index
+            prev_row = first_row + max(plan.row_count(month_index), 1) - 1
 
-        return applicable_months
+    def _retrieve_transactions(self, accounts):
+        # The transactions of all accounts in a single query, grouped by bank. They are sorted by DAY of the month,
+        # ascending, irrespective of the actual month, then by date. Unlimited repetitions first.
+        transactions = self.db_cursor.execute(
+            'SELECT bank, description, subsection, currency, amount, date, interval_kind, interval_months, step, '
+            'repetitions, quote, total_quotes FROM transactions ORDER BY bank, day_of_month, date, reps DESC, rowid')
 
-    @staticmethod
-    def _incr_month(start_date, interval):
-        increment = interval
-        try:
-            next_date = start_date + relativedelta(months=+interval)
-        except Exception as e:
-            if (interval == "Uneven months" and start_date.month % 2) or \
-                    (interval == "Even months" and not start_date.month % 2):
-                increment = 2
-                next_date = start_date + relativedelta(months=+increment)
-            else:
-                increment = 1
-                next_date = start_date + relativedelta(months=+increment)
+        account_transactions = dict((account, []) for account in accounts)
+        for bank, group in itertools.groupby(transactions, key=lambda tr: tr[0]):
+            if bank in account_transactions:
+                account_transactions[bank] = [Transaction(*(tr[:5] + (date.fromordinal(tr[5]),) + tr[6:]))
+                                              for tr in group]
 
-        return next_date, increment
+        return [account_transactions[account] for account in accounts]
 
-    def _load_db(self):
-        self.db_connection = sqlite3.connect(':memory:')
+    @staticmethod
+    def _expand_transactions(transactions, first_month, num_months):
+        start_months, days, kinds, intervals, steps, reps = [], [], [], [], [], []
+        for transaction in transactions:
+            start_date = transaction.date
+            start_months.append(monthcalendar.date_month(start_date))
+            days.append(start_date.day)
+            kinds.append(transaction.interval_kind)
+            intervals.append(transaction.interval)
+            steps.append(transaction.step)
+            reps.append(transaction.repetitions)
+
+        return recurrence.expand(start_months, days, kinds, intervals, steps, reps, first_month, num_months)
+
+    def _connect_db(self):
+        # A loaded input may be used by other threads than the one loading it, one at a time.
+        self.db_connection = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES,
+                                             check_same_thread=False)
         self.db_cursor = self.db_connection.cursor()
+
+    def _load_db(self):
+        self._connect_db()
         self.db_cursor.execute(
             "CREATE TABLE transactions (bank text, description text, subsection text, currency text, "
-            "amount real, date numeric, interval text, reps text, quotes text)")
-
-        # Read the Excel file and fill the database
-        start_row = self._find_row(self.BALANCES_COLS) + 1
-        for row in self.current_sheet.iter_rows(min_row=start_row,
-                                                max_col=len(self.BALANCES_COLS),
-                                                max_row=self.num_rows):
-            if row[0].value is not None:
-                cell_values = ["'{0}'".format(cell.value) for cell in row]
-                insert_string = ','.join(cell_values)
-                insert_string = insert_string.replace("None", "")
-                self.db_cursor.execute("INSERT INTO transactions VALUES ({0})".format(insert_string))
-            else:
-                break
+            "amount real, date integer, interval text, reps text, quotes text, day_of_month integer, "
+            "interval_kind integer, interval_months integer, step integer, repetitions integer, quote integer, "
+            "total_quotes integer)")
+        self.db_cursor.execute(
+            "CREATE TABLE accounts (bank text, currency text, balance numeric, date timestamp)")
+
+        # Read the Excel file and fill the database in a single transaction
+        with self.db_connection:
+            self.db_cursor.executemany("INSERT INTO transactions VALUES "
+                                       "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._read_sections())
+            self.db_cursor.executemany("INSERT INTO accounts VALUES (?, ?, ?, ?)", self.account_rows)
+
+            # Indexed after filling, which is cheaper than keeping the index up to date row by row.
+            self.db_cursor.execute("CREATE INDEX transactions_order ON transactions (bank, day_of_month, date)")
+
+    def _restore_db(self, cache, key):
+        self._connect_db()
+        if not cache.restore(key, self.db_connection):
+            return False
+
+        self.account_rows = self.db_cursor.execute("SELECT * FROM accounts ORDER BY rowid").fetchall()
+        return True
+
+    def _read_sections(self):
+        # Walk the sheet once. The accounts are kept, the transactions are passed on as they are read.
+        self.account_rows = []
+        found = []
+        section = None
+        row_number = 0
+
+        text = self.text_file is not None
+        for row_number, values in enumerate(self.iter_rows(len(self.BALANCES_COLS)), 1):
+            if section is not None:
+                if values[0] is None:
+                    # An empty row ends the section
+                    if len(found) == 2:
+                        break
+                    section = None
+                elif section is self.BANKS_COLS:
+                    if text:
+                        values[2] = self._text_number(values[2], "balance", row_number)
+                    self.account_rows.append(self._parse_account(values, row_number))
+                else:
+                    if text:
+                        values[4] = self._text_number(values[4], "amount", row_number)
+                    yield self._parse_transaction(values, row_number)
+                continue
 
-        self.db_connection.commit()
+            for columns in (self.BANKS_COLS, self.BALANCES_COLS):
+                if columns not in found and self._is_header(values, columns):
+                    found.append(columns)
+                    section = columns
 
-    def _find_row(self, columns):
-        for index, row in enumerate(self.current_sheet.iter_rows(min_row=1,
-                                                                 max_col=len(columns),
-                                                                 max_row=self.num_rows)):
-            row_headers = [str(cell.value) for cell in row]
-            if sorted(row_headers) == sorted(columns):
-                return index + 1
+        instrumentation.count("rows read", row_number)
 
-    def _print_frame(self, account_names, account_cols, transaction_cols, years, months):
-        output = Workbook()
+    @staticmethod
+    def _number_pattern(decimal_mark):
+        # Like 1500, -1,500.00 or 0.5 with a decimal point; the thousands may be separated or not.
+        thousands = "," if decimal_mark == "." else "."
+        return re.compile(r"([+-]?)(\d{{1,3}}(?:{0}\d{{3}})+|\d+)(?:{1}(\d+))?$".format(re.escape(thousands),
+                                                                                   re.escape(decimal_mark)))
+
+    def _text_number(self, value, name, row_number):
+        # Numbers of a text input, as a sheet holds them: whole numbers as int, others as float.
+        if value is None:
+            return value
+
+        match = self.number_pattern.match(value.strip())
+        if match is None:
+            raise ValueError(u"Invalid {0} {1!r} in row {2}, expected a number".format(name, value, row_number))
+
+        sign, whole, fraction = match.groups()
+        whole = sign + re.sub(r"\D", "", whole)
+        return int(whole) if fraction is None else float("{0}.{1}".format(whole, fraction))
+
+    def _parse_account(self, values, row_number):
+        values = list(values[:len(self.BANKS_COLS)])
+        if isinstance(values[3], basestring):
+            try:
+                values[3] = datetime.strptime(values[3].strip(), "%d-%m-%Y")
+            except ValueError:
+                raise ValueError(u"Invalid date {0!r} in row {1}, expected dd-mm-yyyy".format(values[3], row_number))
+        return tuple(values)
+
+    @staticmethod
+    def _parse_transaction(values, row_number):
+        # Empty text cells are stored as empty strings, amounts keep their type.
+        values = ["" if value is None and index != 4 else value for index, value in enumerate(values)]
+        start_date, interval, reps, quotes = values[5:9]
+
+        # Dates are stored as day numbers, with the day of the month apart for ordering.
+        if isinstance(start_date, basestring):
+            try:
+                start_date = datetime.strptime(start_date.strip(), "%d-%m-%Y")
+            except ValueError:
+                pass
+        if not isinstance(start_date, date):
+            raise ValueError(u"Invalid date {0!r} in row {1}, expected dd-mm-yyyy".format(values[5], row_number))
+
+        quote = total_quotes = None
+        if quotes != "":
+            try:
+                quote, total_quotes = [int(x) for x in quotes.split('/')]
+            except (AttributeError, ValueError):
+                raise ValueError(u"Invalid cuotas {0!r} in row {1}, expected #/#".format(quotes, row_number))
+
+        kind, interval_months, step = recurrence.parse_interval(interval)
+        repetitions = recurrence.parse_repetitions(reps, quotes)
+
+        return tuple(values[:5]) + (start_date.toordinal(),) + tuple(values[6:]) + \
+            (start_date.day, kind, interval_months, step, repetitions, quote, total_quotes)
+
+    @staticmethod
+    def _is_header(values, columns):
+        row_headers = [u"{0}".format(value) for value in values[:len(columns)]]
+        return sorted(row_headers) == sorted(columns)
+
+    def _reserve_sections(self, account_names):
         start_row = 1
         start_column = 1
-        # account_names = sorted(self.accounts_current.keys())
-        self.accounts_section.append([start_column, start_row])
-        self.accounts_section.append([len(self.ACCOUNTS_COLS), start_row + len(account_names)])
+        self.accounts_section = [[start_column, start_row],
+                                 [len(self.ACCOUNTS_COLS), start_row + len(account_names)]]
+        self.transaction_section = [[start_column, start_row]]
 
-        # Create sheets for each month until the end of the prognosis
-        now = date.today()
-        then = now + relativedelta(months=+months, years=+years)
-        for monthly in rrule.rrule(rrule.MONTHLY, dtstart=now, until=then):
-            month_sheet = output.create_sheet(title="{0} {1}".format(calendar.month_name[monthly.month], monthly.year))
+    @staticmethod
+    def _prognosis_months(years, months):
+        # One sheet for each month, from the current one until the end of the prognosis
+        first_month = monthcalendar.date_month(date.today())
+        return range(first_month, first_month + years * 12 + months + 1)
+
+    def _print_frame(self, account_names, account_cols, transaction_cols, month_ordinals, shared_strings=None):
+        output = Workbook()
+        self._register_styles(output, account_names)
+        if shared_strings is not None:
+            # The reused sheets of an earlier prognosis refer to its strings by position.
+            output.shared_strings = shared_strings
+
+        written = 0
+        for ordinal in month_ordinals:
+            month_sheet = output.create_sheet(title=monthcalendar.month_title(ordinal))
 
             # TODO: DRY
 
@@ -496,41 +1058,76 @@ class TransactionWorkbook(BudgetWorkbook):
             #     cell.font = self.text_font
             #     cell.value = account_name
 
-            # Reserve section for transactions for each bank
-            next_row = start_row
-            for index, account_name in enumerate(account_names):
-                next_column = 1 + index * (len(self.TRANSACTIONS_COLS) + 1)
-                cell = month_sheet.cell(row=next_row, column=next_column)
-                cell.font = Font(name="Calibri", size=14, bold=True)
-                cell.value = account_name
-                cell.alignment = Alignment(horizontal="justify")
-
-                # Print transaction headers
-                next_row += 2
-                for col_nr, header in enumerate(transaction_cols):
-                    cell = month_sheet.cell(row=next_row, column=next_column + col_nr)
-                    cell.font = self.header_font
-                    cell.value = header
-
-                # Print dummy values for empty transactions later on.
-                next_row += 1
-                for col_nr, header in enumerate(transaction_cols[:-1]):
-                    cell = month_sheet.cell(row=next_row, column=next_column + col_nr)
-                    cell.font = Font(name="Calibri", size=11, color="808080")
-                    cell.value = "N/A"
-                    cell.alignment = Alignment(horizontal="justify")
-
-                next_row -= 3
-
-        self.transaction_section.append([start_column, next_row])
+            for row, column, value, style in self._frame_cells(account_names, transaction_cols):
+                cell = month_sheet.cell(row=row, column=column)
+                cell.value = value
+                self._apply_style(cell, style)
+                written += 1
+
+        instrumentation.count("sheets created", len(month_ordinals))
+        instrumentation.count("cells written", written)
 
         # Remove the empty default sheet at the beginning
         output.remove_sheet(output.active)
 
         return output
 
+    def _frame_cells(self, account_names, transaction_cols):
+        # Reserve section for transactions for each bank
+        start_column, start_row = self.transaction_section[0]
+        for index, account_name in enumerate(account_names):
+            next_column = start_column + index * (len(self.TRANSACTIONS_COLS) + 1)
+            yield start_row, next_column, account_name, "title"
+
+            # Print transaction headers
+            for col_nr, header in enumerate(transaction_cols):
+                yield start_row + 2, next_column + col_nr, header, "header"
+
+            # Print dummy values for empty transactions later on.
+            for col_nr, header in enumerate(transaction_cols[:-1]):
+                yield start_row + 3, next_column + col_nr, "N/A", "na"
+
     def __del__(self):
-        self.db_connection.close()
+        if self.db_connection is not None:
+            self.db_connection.close()
+
+
+def plan_accounts(accounts, account_transactions, first_month, num_months):
+    """
+    Plans a number of accounts, given as (name, currency, balance, balance date, column) with their transactions.
+    The transactions of all of them are expanded at once.
+    """
+    with instrumentation.span("expand"):
+        occurrences = TransactionWorkbook._expand_transactions([tr for trs in account_transactions for tr in trs],
+                                                               first_month, num_months)
+    instrumentation.count("occurrences expanded", len(occurrences.transaction))
+
+    # Keep the occurrences within the prognosis, ordered by account and month. Within a month they stay in the
+    # order of the transactions, which are sorted by day of the month.
+    num_transactions = [len(trs) for trs in account_transactions]
+    transaction_offsets = np.cumsum([0] + num_transactions)
+    account = np.repeat(np.arange(len(accounts)), num_transactions)[occurrences.transaction]
+    month_index = occurrences.month - first_month
+    order = np.lexsort((month_index, account))
+    order = order[(month_index[order] >= 0) & (month_index[order] < num_months)]
+    account_bounds = np.searchsorted(account[order], np.arange(len(accounts) + 1))
+    instrumentation.count("occurrences planned", len(order))
+
+    plans = []
+    for bank_nr, (name, currency, balance, balance_date, column) in enumerate(accounts):
+        selection = order[account_bounds[bank_nr]:account_bounds[bank_nr + 1]]
+        plans.append(AccountPlan(name, currency, balance, balance_date, column, first_month, num_months,
+                                 account_transactions[bank_nr],
+                                 occurrences.transaction[selection] - transaction_offsets[bank_nr],
+                                 occurrences.sequence[selection], month_index[selection], occurrences.day[selection]))
+
+    return plans
+
+
+def _plan_account_job(job):
+    plan, = plan_accounts(*job)
+    plan.build_rows()
+    return plan
 
 
 class PrognosisWorkbook(BudgetWorkbook):
@@ -539,9 +1136,54 @@ class PrognosisWorkbook(BudgetWorkbook):
 
 
 def main():
-    calculator = BudgetCalc()
-    calculator.read_input(sys.argv[1])
-    calculator.save_prognosis(sys.argv[2], years=int(sys.argv[3]), months=int(sys.argv[4]))
+    parser = argparse.ArgumentParser(description="Calculate a budget prognosis from a balance workbook.")
+    parser.add_argument("input", help="the balance workbook")
+    parser.add_argument("folder", help="the folder to save the prognosis in")
+    parser.add_argument("years", type=int)
+    parser.add_argument("months", type=int)
+    parser.add_argument("--write-only", action="store_true",
+                        help="stream the prognosis sheet by sheet, keeping memory flat for long horizons")
+    parser.add_argument("--formulas", action="store_true",
+                        help="calculate the balances with spreadsheet formulas instead of writing their values")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes planning the accounts in parallel (default: %(default)s)")
+    parser.add_argument("--cache-dir", default=DEFAULT_DIRECTORY,
+                        help="folder of the cache of parsed inputs (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="always parse the input workbook")
+    parser.add_argument("--encoding", help="encoding of a CSV or TSV input, like cp1252 (default: UTF-8)")
+    parser.add_argument("--decimal-mark", choices=DECIMAL_MARKS, default=".",
+                        help="decimal mark of the numbers of a CSV or TSV input; the other one separates their "
+                             "thousands (default: %(default)s)")
+    parser.add_argument("--summary", action="store_true",
+                        help="add a sheet with the balance of every account at the end of every month")
+    parser.add_argument("--format", choices=("xlsx",) + rowexport.FORMATS, default="xlsx",
+                        help="save a workbook, or only the rows of the prognosis as CSV or JSON Lines "
+                             "(default: %(default)s)")
+    parser.add_argument("--per-month", action="store_true",
+                        help="with a row format, save every month in a file of its own")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only write the month sheets that changed since the prognosis was saved before, keeping "
+                             "its state in the cache folder")
+    parser.add_argument("--profile", metavar="REPORT",
+                        help="write the time of every phase and counts of the work done as JSON to REPORT, or to "
+                             "the standard error for -. Also enabled by the {0} environment variable"
+                        .format(instrumentation.ENVIRONMENT_VARIABLE))
+    parser.add_argument("--profile-cpu", metavar="STATS", help="with --profile, save cProfile statistics to STATS")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="with --profile, report the peak Python memory use (needs tracemalloc)")
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable(report_file=args.profile, profile_file=args.profile_cpu,
+                               trace_memory=args.profile_memory)
+
+    cache = None if args.no_cache else InputCache(PARSER_VERSION, directory=args.cache_dir)
+    states = PrognosisStates(directory=args.cache_dir) if args.incremental else None
+    calculator = BudgetCalc(cache=cache, states=states)
+    calculator.read_input(args.input, encoding=args.encoding, decimal_mark=args.decimal_mark)
+    calculator.save_prognosis(args.folder, years=args.years, months=args.months, write_only=args.write_only,
+                              formulas=args.formulas, workers=args.workers, summary=args.summary,
+                              output_format=args.format, per_month=args.per_month)
 
 
 if __name__ == '__main__':
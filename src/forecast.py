@@ -0,0 +1,167 @@
+"""
+ Balances of the accounts over a prognosis, queried without writing a workbook or evaluating its formulas.
+
+ Every account keeps the days with transactions counting for its balance as day ordinals in ascending order, with the
+ balance at the end of each of them. The balance at a date is found by binary search. The lowest and highest balance
+ over a range of dates come from tables holding the minimum and maximum of every run of 2^k consecutive balances, so a
+ range of any length is covered by two runs of them.
+
+ The balance of an account is only known from its balance date until the end of the prognosis. Queries outside of
+ that return None.
+"""
+
+from collections import OrderedDict
+from datetime import date
+
+import numpy as np
+
+import monthcalendar
+
+
+def _day(value):
+    return value if isinstance(value, (int, long)) else value.toordinal()
+
+
+class AccountForecast(object):
+    def __init__(self, name, currency, balance_date, days, balances, last_day):
+        """
+        The account starts at balances[0] on its balance date. days holds the days with transactions from then on,
+        and balances[i + 1] the balance at the end of days[i].
+        """
+        self.name = name
+        self.currency = currency
+        self.date = balance_date
+        self.days = days
+        self.balances = balances
+        self.first_day = balance_date.toordinal()
+        self.last_day = last_day
+        self._ranges = None
+
+    @classmethod
+    def from_occurrences(cls, name, currency, balance_date, balance, days, amounts, last_day):
+        """
+        The forecast of an account from its balance and the transactions from its balance date on, as their days in
+        ascending order and their amounts.
+        """
+        balances = np.cumsum(np.concatenate(([balance], amounts)))[1:]
+
+        # Only the balance after the last transaction of a day counts, the order within a day is arbitrary.
+        last = np.append(days[1:] != days[:-1], True) if len(days) else np.zeros(0, dtype=bool)
+        return cls(name, currency, balance_date, days[last],
+                   np.concatenate(([balance], balances[last])).astype(np.float64), last_day)
+
+    def _position(self, day):
+        # The position in balances of the balance at the end of the day.
+        return int(np.searchsorted(self.days, day, side="right"))
+
+    def balance_at(self, day):
+        """
+        The balance at the end of a day, given as a date or day ordinal.
+        """
+        day = _day(day)
+        if not self.first_day <= day <= self.last_day:
+            return None
+        return float(self.balances[self._position(day)])
+
+    def balances_at(self, days):
+        """
+        The balances at the end of a number of days, as day ordinals, with NaN where the balance is not known.
+        """
+        days = np.asarray(days, dtype=np.int64)
+        balances = self.balances[np.searchsorted(self.days, days, side="right")]
+        return np.where((days >= self.first_day) & (days <= self.last_day), balances, np.nan)
+
+    def min_balance(self, start, end):
+        """
+        The lowest balance from the end of the start day until the end of the end day, or None if none is known.
+        """
+        return self._range(start, end, 0)
+
+    def max_balance(self, start, end):
+        """
+        The highest balance from the end of the start day until the end of the end day, or None if none is known.
+        """
+        return self._range(start, end, 1)
+
+    def first_negative(self):
+        """
+        The first day ending with a negative balance, or None if the balance stays positive.
+        """
+        negative = np.flatnonzero(self.balances < 0)
+        if not len(negative):
+            return None
+
+        day = self.first_day if negative[0] == 0 else int(self.days[negative[0] - 1])
+        return date.fromordinal(day) if day <= self.last_day else None
+
+    def _range(self, start, end, table):
+        start, end = max(_day(start), self.first_day), min(_day(end), self.last_day)
+        if start > end:
+            return None
+
+        # The balances from the one at the end of the start day up to the one at the end of the end day
+        first, last = self._position(start), self._position(end) + 1
+        level = (last - first).bit_length() - 1
+        runs = self._range_tables()[table][level]
+        pick = min if table == 0 else max
+        return float(pick(runs[first], runs[last - (1 << level)]))
+
+    def _range_tables(self):
+        # Built at the first query over a range, for the minima and maxima of runs of 1, 2, 4, ... balances.
+        if self._ranges is None:
+            minima, maxima = [self.balances], [self.balances]
+            width = 1
+            while width * 2 <= len(self.balances):
+                minima.append(np.minimum(minima[-1][:-width], minima[-1][width:]))
+                maxima.append(np.maximum(maxima[-1][:-width], maxima[-1][width:]))
+                width *= 2
+            self._ranges = (minima, maxima)
+        return self._ranges
+
+
+class Forecast(object):
+    """
+    The forecast balances of the accounts of a prognosis, by account name.
+    """
+
+    def __init__(self, month_ordinals, accounts):
+        self.month_ordinals = list(month_ordinals)
+        self.month_ends = monthcalendar.first_days(np.asarray(self.month_ordinals) + 1) - 1
+        self.accounts = OrderedDict((account.name, account) for account in accounts)
+
+    @classmethod
+    def from_plans(cls, month_ordinals, plans):
+        month_ordinals = list(month_ordinals)
+        month_starts = monthcalendar.first_days(month_ordinals)
+        last_day = int(monthcalendar.first_days([month_ordinals[-1] + 1])[0]) - 1
+
+        accounts = []
+        for plan in plans:
+            # Without a sheet for the balance date, the balances of the account are not known.
+            if not plan.balance_in_range:
+                continue
+
+            accounts.append(AccountForecast.from_occurrences(
+                plan.name, plan.currency, plan.date, plan.carried_balance(0), plan.active_days(month_starts),
+                plan.amounts()[plan.transaction[plan.active]], last_day))
+        return cls(month_ordinals, accounts)
+
+    def balance_at(self, name, day):
+        return self.accounts[name].balance_at(day)
+
+    def min_balance(self, name, start, end):
+        return self.accounts[name].min_balance(start, end)
+
+    def max_balance(self, name, start, end):
+        return self.accounts[name].max_balance(start, end)
+
+    def first_negative_dates(self):
+        return OrderedDict((name, account.first_negative()) for name, account in self.accounts.items())
+
+    def month_end_balances(self):
+        """
+        The balance of every account (rows) at the end of every month (columns), NaN where it is not known.
+        """
+        if not self.accounts:
+            return np.zeros((0, len(self.month_ordinals)))
+        return np.vstack([account.balances_at(self.month_ends) for account in self.accounts.values()])
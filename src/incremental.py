@@ -0,0 +1,157 @@
+"""
+ Incremental prognoses, rewriting only the month sheets that changed since the prognosis was saved before.
+
+ The state of a prognosis holds a fingerprint of its layout (months, accounts and options) and, for every account, a
+ fingerprint of the account with its transactions and of the cells of the account in every month. Saving the same
+ prognosis again compares those. Month sheets in which no account changed are copied from the earlier output as they
+ are, the others are written again.
+
+ Copied sheets keep referring to the shared strings and cell styles of the earlier output. The new output therefore
+ starts with the shared strings of the earlier one, and the cell styles are registered in the same order in every
+ prognosis (see TransactionWorkbook._register_styles).
+"""
+
+import os
+import json
+import time
+import stat
+import hashlib
+import zipfile
+import tempfile
+
+from openpyxl.reader.strings import read_string_table
+
+from inputcache import DEFAULT_DIRECTORY, DEFAULT_MAX_AGE
+
+STATE_VERSION = 1
+STATE_SUFFIX = ".prognosis.json"
+SHARED_STRINGS_PART = "xl/sharedStrings.xml"
+SHEET_PART = "xl/worksheets/sheet{0}.xml"
+
+
+def fingerprint(value):
+    return hashlib.sha1(repr(value)).hexdigest()
+
+
+class PrognosisStates(object):
+    """
+    The states of the prognoses saved incrementally, one per folder, horizon and tag.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_age=DEFAULT_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+
+    def key(self, folder, years, months, tag=None):
+        return fingerprint((os.path.realpath(folder), years, months, tag))
+
+    def path(self, key):
+        return os.path.join(self.directory, key + STATE_SUFFIX)
+
+    def load(self, key):
+        """
+        Returns the state of the prognosis saved before, or an empty state if there is none to build on: its output
+        was removed or changed since, or it was saved by another version.
+        """
+        try:
+            with open(self.path(key)) as state_file:
+                state = json.load(state_file)
+            status = os.stat(state["output"])
+        except (OSError, IOError, ValueError, KeyError, TypeError):
+            return {}
+
+        if state.get("version") != STATE_VERSION or [status.st_size, status.st_mtime] != state.get("output_status"):
+            return {}
+        return state
+
+    def store(self, key, output, state):
+        status = os.stat(output)
+        state = dict(state, version=STATE_VERSION, output=os.path.realpath(output),
+                     output_status=[status.st_size, status.st_mtime])
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            handle, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            with os.fdopen(handle, "w") as state_file:
+                json.dump(state, state_file)
+            os.rename(temp_path, self.path(key))
+        except (OSError, IOError):
+            # Without a state the next prognosis is written in full, which is still correct.
+            return
+
+        self.evict()
+
+    def evict(self):
+        # States are stored again on every save, so an old state belongs to a prognosis that is not saved anymore.
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(STATE_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.stat(path).st_mtime > self.max_age:
+                    os.remove(path)
+            except OSError:
+                continue
+
+
+def unchanged_months(previous, state, num_months):
+    """
+    The indexes of the months in which no account changed since the previous state.
+    """
+    if not previous.get("output") or previous.get("layout") != state["layout"]:
+        return set()
+
+    unchanged = set(range(num_months))
+    for name, account in state["accounts"].items():
+        months = previous["accounts"].get(name, {}).get("months")
+        if months is None:
+            return set()
+        unchanged.difference_update(index for index in list(unchanged) if months[index] != account["months"][index])
+    return unchanged
+
+
+def read_shared_strings(output):
+    with zipfile.ZipFile(output) as archive:
+        if SHARED_STRINGS_PART not in archive.namelist():
+            return None
+        return read_string_table(archive.read(SHARED_STRINGS_PART))
+
+
+def _output_mode(filename):
+    # The mode the output would have if written in place: that of the file it replaces, or the default under the
+    # umask. Temporary files are only readable by their owner.
+    try:
+        return stat.S_IMODE(os.stat(filename).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def temporary_output(filename):
+    handle, temp_path = tempfile.mkstemp(suffix=".xlsx", dir=os.path.dirname(filename) or os.curdir)
+    os.close(handle)
+    return temp_path
+
+
+def splice(previous_output, patched, filename, reused_months):
+    """
+    Writes filename as the patched workbook, with the sheets of the reused months taken from the previous output.
+    """
+    reused_parts = set(SHEET_PART.format(index + 1) for index in reused_months)
+    temp_path = temporary_output(filename)
+    try:
+        with zipfile.ZipFile(previous_output) as previous, zipfile.ZipFile(patched) as source, \
+                zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED) as output:
+            for info in source.infolist():
+                part = previous if info.filename in reused_parts else source
+                output.writestr(info, part.read(info.filename))
+
+        # The previous output may be the one replaced.
+        os.chmod(temp_path, _output_mode(filename))
+        os.rename(temp_path, filename)
+    except Exception:
+        os.remove(temp_path)
+        raise
@@ -0,0 +1,139 @@
+"""
+ On-disk cache of parsed input workbooks.
+
+ A parsed input is a small SQLite database. The cache keeps a copy of it per input, keyed by a hash of the input
+ file, the options it was parsed with and the version of the parser that produced it, so unchanged inputs are not
+ parsed again.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+
+DEFAULT_DIRECTORY = os.environ.get("BUDGETCALC_CACHE_DIR",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "budgetcalc"))
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+CACHE_SUFFIX = ".sqlite"
+
+
+class InputCache(object):
+    def __init__(self, version, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.version = version
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def key(self, filename, options=None):
+        # Options changing how the input is parsed give a parse of their own.
+        digest = hashlib.sha1("budgetcalc-parser-{0}\n{1!r}\n".format(self.version, options))
+        with open(filename, "rb") as input_file:
+            for chunk in iter(lambda: input_file.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def restore(self, key, connection):
+        """
+        Copies the cached tables and indexes into the connection. Returns False if the input is not cached.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return False
+
+        try:
+            self._copy(connection, path, "cache", from_cache=True)
+        except sqlite3.Error:
+            # A damaged entry is dropped and the input parsed again.
+            self._remove(path)
+            return False
+
+        # Keep recently used entries from being evicted first
+        os.utime(path, None)
+        return True
+
+    def store(self, key, connection):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            # Concurrent runs may store the same input. Every run writes its own file and renames it into place.
+            handle, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            os.close(handle)
+            try:
+                self._copy(connection, temp_path, "cache", from_cache=False)
+                os.rename(temp_path, self.path(key))
+            finally:
+                self._remove(temp_path)
+        except (OSError, IOError, sqlite3.Error):
+            # The cache is only an optimization; the parsed input is still valid.
+            return
+
+        self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+
+            if now - status.st_mtime > self.max_age:
+                self._remove(path)
+            else:
+                entries.append((status.st_mtime, status.st_size, path))
+
+        # Remove the least recently used entries until the cache fits.
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _copy(connection, path, alias, from_cache):
+        source, target = (alias, "main") if from_cache else ("main", alias)
+
+        if not from_cache:
+            # Create the schema through its original statements, so declared column types are kept.
+            schema = connection.execute("SELECT sql FROM main.sqlite_master WHERE type IN ('table', 'index') "
+                                        "AND sql IS NOT NULL ORDER BY type DESC").fetchall()
+            cache_connection = sqlite3.connect(path)
+            with cache_connection:
+                for (sql,) in schema:
+                    cache_connection.execute(sql)
+            cache_connection.close()
+
+        connection.execute("ATTACH DATABASE ? AS {0}".format(alias), (path,))
+        try:
+            with connection:
+                objects = connection.execute("SELECT type, name, sql FROM {0}.sqlite_master "
+                                             "WHERE type IN ('table', 'index') AND sql IS NOT NULL "
+                                             "ORDER BY type DESC".format(source)).fetchall()
+                for object_type, name, sql in objects:
+                    if object_type == "table":
+                        if from_cache:
+                            connection.execute(sql)
+                        connection.execute("INSERT INTO {0}.{1} SELECT * FROM {2}.{1} ORDER BY rowid"
+                                           .format(target, name, source))
+                    elif from_cache:
+                        connection.execute(sql)
+        finally:
+            connection.execute("DETACH DATABASE {0}".format(alias))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,159 @@
+"""
+ Timing spans and counters of the phases of a run, reported as JSON.
+
+ Instrumentation is off unless enabled, on the command line or by naming a report file in the BUDGETCALC_PROFILE
+ environment variable. While off, span() hands out a shared empty context and count() returns at once, so the
+ instrumented code runs as it would without them.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+
+try:
+    import resource
+except ImportError:
+    # Unix only, there is no peak resident set size to report elsewhere.
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Part of the standard library from Python 3.4 on, a separate package before.
+    tracemalloc = None
+
+ENVIRONMENT_VARIABLE = "BUDGETCALC_PROFILE"
+STDERR = "-"
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Span(object):
+    __slots__ = ("instrumentation", "name", "start")
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.instrumentation.stack.append(self.name)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.time() - self.start
+        stack = self.instrumentation.stack
+        path = "/".join(stack)
+        stack.pop()
+
+        calls, total = self.instrumentation.spans.get(path, (0, 0.0))
+        self.instrumentation.spans[path] = (calls + 1, total + seconds)
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Instrumentation(object):
+    def __init__(self):
+        self.enabled = False
+        self.report_file = None
+        self.stack = []
+        self.spans = {}
+        self.counters = {}
+        self.profiler = None
+        self.profile_file = None
+        self.trace_memory = False
+
+    def enable(self, report_file=STDERR, profile_file=None, trace_memory=False):
+        """
+        Starts collecting spans and counters. The report is written to report_file when the process exits, unless it
+        is None and the caller takes the report itself. A profile_file also gets the cProfile statistics of the run,
+        trace_memory adds the peak of the memory allocated by Python and its largest sources, if tracemalloc is
+        available.
+        """
+        if not self.enabled:
+            atexit.register(self.write_report)
+        self.enabled = True
+        self.report_file = report_file
+
+        if profile_file is not None and self.profiler is None:
+            self.profile_file = profile_file
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        self.trace_memory = trace_memory
+        if trace_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def span(self, name):
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self):
+        spans = dict((path, {"calls": calls, "seconds": round(seconds, 6)})
+                     for path, (calls, seconds) in self.spans.items())
+
+        # On Linux the maximum resident set size is in kilobytes.
+        peak_rss_kb = None if resource is None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report = {"spans": spans, "counters": dict(self.counters), "peak_rss_kb": peak_rss_kb}
+
+        if self.profile_file is not None:
+            report["profile_file"] = self.profile_file
+
+        if self.trace_memory:
+            if tracemalloc is None or not tracemalloc.is_tracing():
+                report["memory"] = None
+            else:
+                current, peak = tracemalloc.get_traced_memory()
+                top = tracemalloc.take_snapshot().statistics("lineno")[:10]
+                report["memory"] = {"current_bytes": current, "peak_bytes": peak,
+                                    "top": [{"source": str(statistic.traceback), "bytes": statistic.size}
+                                            for statistic in top]}
+        return report
+
+    def write_report(self):
+        if not self.enabled:
+            return
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_file)
+            self.profiler = None
+
+        text = json.dumps(self.report(), indent=2, sort_keys=True)
+        if self.report_file == STDERR:
+            sys.stderr.write(text + "\n")
+        elif self.report_file is not None:
+            with open(self.report_file, "w") as report_file:
+                report_file.write(text + "\n")
+
+        # Written once, even if asked for again at exit.
+        self.enabled = False
+
+
+_instrumentation = Instrumentation()
+
+enable = _instrumentation.enable
+span = _instrumentation.span
+count = _instrumentation.count
+report = _instrumentation.report
+write_report = _instrumentation.write_report
+
+if os.environ.get(ENVIRONMENT_VARIABLE):
+    enable(report_file=os.environ[ENVIRONMENT_VARIABLE])
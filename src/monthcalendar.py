@@ -0,0 +1,102 @@
+"""
+ Months as integer ordinals (year * 12 + month - 1).
+
+ Months are counted, stepped through and used as keys by their ordinal. Their titles are only made when a sheet or a
+ filename needs them.
+"""
+
+import calendar
+
+import numpy as np
+
+# Days of every month, in a common and in a leap year
+_DAYS_IN_MONTH = np.array([[31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+                           [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]], dtype=np.int64)
+
+# Days of the year before every month, in a common year
+_DAYS_BEFORE_MONTH = np.concatenate(([0], np.cumsum(_DAYS_IN_MONTH[0][:-1])))
+
+# Names of the months in the current locale, from January on
+_MONTH_NAMES = [calendar.month_name[month] for month in range(1, 13)]
+
+
+def date_month(day):
+    # The ordinal of the month a date is in.
+    return day.year * 12 + day.month - 1
+
+
+def ordinal_year_month(ordinal):
+    year, month = divmod(ordinal, 12)
+    return year, month + 1
+
+
+def is_leap(years):
+    return ((years % 4 == 0) & (years % 100 != 0)) | (years % 400 == 0)
+
+
+def days_in_month(ordinal):
+    year, month = divmod(ordinal, 12)
+    return int(_DAYS_IN_MONTH[int(is_leap(year)), month])
+
+
+def days_in_months(ordinals):
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    years, months = np.divmod(ordinals, 12)
+    return _DAYS_IN_MONTH[is_leap(years).astype(np.int64), months]
+
+
+def first_days(ordinals):
+    """
+    The day ordinals (as date.toordinal gives) of the first day of every month.
+    """
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    years, months = np.divmod(ordinals, 12)
+    before = years - 1
+    return (before * 365 + before // 4 - before // 100 + before // 400 + _DAYS_BEFORE_MONTH[months] +
+            ((months > 1) & is_leap(years)) + 1)
+
+
+def clamp_day(ordinal, day):
+    # A day past the end of the month is the last day of the month.
+    return min(day, days_in_month(ordinal))
+
+
+def add_months(day, months):
+    """
+    The same day of the month, a number of months later (or earlier). Days past the end of that month become its
+    last day, like adding a relativedelta of months does.
+    """
+    ordinal = date_month(day) + months
+    year, month = ordinal_year_month(ordinal)
+    return day.replace(year=year, month=month, day=clamp_day(ordinal, day.day))
+
+
+def months_between(end, start):
+    """
+    The whole months from one date to another, counted towards zero like relativedelta(end, start) does: the
+    day of the month of start has to be reached in the last month for it to count.
+    """
+    months = date_month(end) - date_month(start)
+    if end >= start:
+        while months > 0 and add_months(start, months) > end:
+            months -= 1
+    else:
+        while months < 0 and add_months(start, months) < end:
+            months += 1
+    return months
+
+
+def month_title(ordinal):
+    year, month = ordinal_year_month(ordinal)
+    return "{0} {1}".format(_MONTH_NAMES[month - 1], year)
+
+
+def short_month_title(ordinal):
+    year, month = ordinal_year_month(ordinal)
+    return "{0}{1}".format(_MONTH_NAMES[month - 1][:3], year)
+
+
+def iso_month(ordinal):
+    # Like "2026-10", the same in every locale and sorting in time order.
+    year, month = ordinal_year_month(ordinal)
+    return "{0:04d}-{1:02d}".format(year, month)
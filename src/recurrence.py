@@ -0,0 +1,118 @@
+"""
+ Batch expansion of recurring transactions into monthly occurrences.
+
+ Months are handled as integer ordinals (see monthcalendar), so all transactions of all accounts can be expanded
+ at once with array arithmetic instead of stepping through the calendar one month at a time.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from monthcalendar import days_in_months
+
+# Interval kinds, as parsed from the "Interval (# months)" column
+INTERVAL_MONTHS = 0     # Every n months. An empty interval means every month.
+INTERVAL_EVEN = 1       # "Even months"
+INTERVAL_UNEVEN = 2     # "Uneven months"
+INTERVAL_OTHER = 3      # Any other text: every month, but the first step counts as two against the range.
+
+EVEN_MONTHS = "Even months"
+UNEVEN_MONTHS = "Uneven months"
+
+UNLIMITED = -1
+
+Occurrences = namedtuple("Occurrences", ["transaction", "sequence", "month", "day"])
+
+
+def parse_interval(value):
+    """
+    Returns (kind, interval, step) for an interval cell. The step is what the first occurrence consumes from the
+    remaining range of months, which is not always the interval itself.
+    """
+    try:
+        interval = int(value)
+        return INTERVAL_MONTHS, interval, interval
+    except ValueError:
+        if value == "":
+            return INTERVAL_MONTHS, 1, 1
+        elif value == EVEN_MONTHS:
+            return INTERVAL_EVEN, 2, 2
+        elif value == UNEVEN_MONTHS:
+            return INTERVAL_UNEVEN, 2, 2
+        else:
+            return INTERVAL_OTHER, 1, 2
+
+
+def parse_repetitions(reps, quotes):
+    """
+    Returns the number of repetitions. If not defined explicitly, the quotes (#/#) define them. Without either the
+    repetitions are UNLIMITED, i.e. until the end of the prognosis.
+    """
+    try:
+        if reps == "":
+            quote_num, total_quotes = [int(x) for x in quotes.split('/')]
+            repetitions = (total_quotes - quote_num) + 1
+        else:
+            repetitions = int(reps)
+    except ValueError:
+        return UNLIMITED
+
+    # Fewer than one repetition still gives the first occurrence. A count like -1 (or cuotas "11/9") must not be
+    # taken for UNLIMITED.
+    return max(repetitions, 0)
+
+
+def expand(start_months, days, kinds, intervals, steps, reps, first_month, num_months):
+    """
+    Expands a batch of transactions into their occurrences within a prognosis of num_months months starting at
+    the month ordinal first_month. All arguments but the last two are equally long sequences, one entry per
+    transaction.
+
+    The occurrences are returned grouped per transaction, in the order of the input, and in chronological order
+    within each transaction. The sequence is the number of the occurrence within its transaction (0 for the
+    first), the day is clamped to the length of the month.
+    """
+    start_months = np.asarray(start_months, dtype=np.int64)
+    days = np.asarray(days, dtype=np.int64)
+    kinds = np.asarray(kinds, dtype=np.int64)
+    intervals = np.asarray(intervals, dtype=np.int64)
+    steps = np.asarray(steps, dtype=np.int64)
+    reps = np.asarray(reps, dtype=np.int64)
+
+    # The months left in the prognosis, counted from the first occurrence of each transaction.
+    months_in_range = num_months - (start_months - first_month)
+    reps = np.where(reps == UNLIMITED, months_in_range, reps)
+    extra_reps = np.maximum(reps - 1, 0)
+
+    # The first occurrence always counts. After that, a next occurrence exists as long as its offset from the
+    # first occurrence stays below what remains of the range after the first step.
+    remaining = months_in_range - steps
+    positive = remaining > 0
+    safe_intervals = np.where(intervals > 0, intervals, 1)
+
+    # For even/uneven months the first increment is one or two months, depending on the start month.
+    start_is_even = (start_months % 12) % 2 == 1
+    parity_matches = np.where(kinds == INTERVAL_EVEN, start_is_even, ~start_is_even)
+    first_increment = np.where(parity_matches, 2, 1)
+
+    cap_months = np.where(intervals > 0, -(-remaining // safe_intervals), extra_reps)
+    cap_parity = 1 + np.maximum(0, -(-(remaining - first_increment) // 2))
+    cap = np.select([kinds == INTERVAL_MONTHS, kinds == INTERVAL_OTHER], [cap_months, remaining],
+                    default=cap_parity)
+    cap = np.where(positive, cap, 0)
+
+    counts = 1 + np.minimum(extra_reps, cap)
+
+    transaction = np.repeat(np.arange(len(counts)), counts)
+    group_start = np.cumsum(counts) - counts
+    sequence = np.arange(len(transaction)) - np.repeat(group_start, counts)
+
+    kind = kinds[transaction]
+    offset = np.select([kind == INTERVAL_MONTHS, kind == INTERVAL_OTHER],
+                       [intervals[transaction] * sequence, sequence],
+                       default=np.where(sequence > 0, first_increment[transaction] + 2 * (sequence - 1), 0))
+    month = start_months[transaction] + offset
+    day = np.minimum(days[transaction], days_in_months(month))
+
+    return Occurrences(transaction, sequence, month, day)
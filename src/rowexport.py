@@ -0,0 +1,114 @@
+"""
+ Prognoses as plain rows for other programs, in CSV or JSON Lines, instead of a workbook.
+
+ Every row is a transaction of an account in a month of the prognosis, or the current balance of the account, with the
+ balance after it as planned. Rows are made from the plans one month at a time while they are written, without a
+ workbook, styles or column widths. The whole prognosis goes to one file, or every month to a file of its own.
+
+    month,account,currency,kind,description,subsection,amount,date,balance
+    2026-10,Bank A,AR$,current,CURRENT BALANCE,,,2026-10-05,1500.0
+    2026-10,Bank A,AR$,active,TV (3/12),Home,-120.5,2026-10-10,1379.5
+
+ Transactions before the balance date do not count for the balance. Their kind is "pre" and they have no balance.
+"""
+
+import os
+import csv
+import json
+import itertools
+from datetime import date
+
+import monthcalendar
+
+FORMATS = ("csv", "jsonl")
+FIELDS = ("month", "account", "currency", "kind", "description", "subsection", "amount", "date", "balance")
+
+# Names of the kinds of planned rows, by budgetcalc.ROW_CURRENT, ROW_ACTIVE and ROW_PRE
+ROW_KINDS = ("current", "active", "pre")
+
+
+def month_rows(month_ordinals, plans, month_index):
+    """
+    The rows of all accounts in a month, account after account, as tuples of FIELDS.
+    """
+    month = monthcalendar.iso_month(month_ordinals[month_index])
+    for plan in plans:
+        for kind, description, subsection, amount, work_date, balance in plan.month_rows(month_index):
+            # The current balance has no amount.
+            yield (month, plan.name, plan.currency, ROW_KINDS[kind], description, subsection,
+                   None if amount == "" else amount, work_date, balance)
+
+
+def prognosis_rows(month_ordinals, plans):
+    return itertools.chain.from_iterable(month_rows(month_ordinals, plans, month_index)
+                                         for month_index in range(len(month_ordinals)))
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        # str() would round to 12 digits.
+        return repr(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def _json_value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError("{0!r} is not JSON serializable".format(value))
+
+
+# json.dumps with options makes an encoder on every call, this one is made once. Sorting the keys (or keeping them
+# in an OrderedDict) would leave out the C encoder.
+_JSON_ENCODER = json.JSONEncoder(default=_json_value)
+
+
+def check_format(output_format):
+    if output_format not in FORMATS:
+        raise ValueError("Unknown row format {0}, should be one of {1}".format(output_format, ", ".join(FORMATS)))
+
+
+def write_rows(stream, rows, output_format):
+    """
+    Writes rows to an open (binary) stream, as CSV with a header or as JSON Lines. Returns the number of rows.
+    """
+    check_format(output_format)
+    count = 0
+    if output_format == "csv":
+        writer = csv.writer(stream, lineterminator="\n")
+        writer.writerow(FIELDS)
+        for row in rows:
+            writer.writerow([_csv_value(value) for value in row])
+            count += 1
+    else:
+        for row in rows:
+            stream.write(_JSON_ENCODER.encode(dict(zip(FIELDS, row))))
+            stream.write("\n")
+            count += 1
+    return count
+
+
+def save(filename, month_ordinals, plans, output_format, per_month=False):
+    """
+    Saves the rows of a prognosis as filename, or with per_month, every month as a file of its own in the folder
+    filename, named after the month (2026-10.csv). Returns the number of rows.
+    """
+    check_format(output_format)
+    if not per_month:
+        with open(filename, "wb") as output:
+            return write_rows(output, prognosis_rows(month_ordinals, plans), output_format)
+
+    if not os.path.isdir(filename):
+        os.makedirs(filename)
+
+    count = 0
+    for month_index, ordinal in enumerate(month_ordinals):
+        month_filename = os.path.join(filename, "{0}.{1}".format(monthcalendar.iso_month(ordinal), output_format))
+        with open(month_filename, "wb") as output:
+            count += write_rows(output, month_rows(month_ordinals, plans, month_index), output_format)
+    return count
@@ -0,0 +1,230 @@
+"""
+ What-if scenarios evaluated on the expanded transactions of a prognosis, without writing a workbook for each.
+
+ A scenario is a list of changes to the transactions that match some of their columns: their amounts multiplied,
+ their occurrences left out or moved a number of months. The occurrences are expanded once into a schedule; every
+ scenario only goes over the occurrences it changes and the accounts they belong to, and gives a forecast with the
+ balances of all accounts at the end of every month and the first day each of them ends negative.
+
+    [{"name": "Rent up 8%", "changes": [{"match": {"description": "Rent"}, "multiplier": 1.08}]},
+     {"name": "No TV cuotas", "changes": [{"match": {"description": "TV"}, "exclude": true, "start": "2026-11-01"}]},
+     {"name": "Salary late", "changes": [{"match": {"subsection": "Salary"}, "shift": 1}]}]
+
+ Only the occurrences within the prognosis are known. Occurrences moved past its end drop out, and moving them
+ earlier does not bring in occurrences from after it. Occurrences are never moved before the balance date.
+"""
+
+import json
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+import monthcalendar
+from forecast import AccountForecast, Forecast
+from budgetcalc import TransactionWorkbook, PARSER_VERSION
+from inputcache import InputCache, DEFAULT_DIRECTORY
+
+# The columns of the transactions a change can match
+MATCH_FIELDS = ("bank", "description", "subsection", "currency")
+
+
+class Change(object):
+    """
+    A change to the transactions matching all given columns, for their occurrences from start until end (both
+    dates included, either left open).
+    """
+
+    def __init__(self, match, multiplier=1.0, exclude=False, shift=0, start=None, end=None):
+        unknown = set(match) - set(MATCH_FIELDS)
+        if unknown:
+            raise ValueError("Cannot match transactions on {0}, only on {1}".format(
+                ", ".join(sorted(unknown)), ", ".join(MATCH_FIELDS)))
+        self.match = match
+        self.multiplier = 0.0 if exclude else float(multiplier)
+        self.shift = int(shift)
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("match", {}), multiplier=data.get("multiplier", 1.0), exclude=data.get("exclude", False),
+                   shift=data.get("shift", 0), start=_parse_date(data.get("start")),
+                   end=_parse_date(data.get("end")))
+
+
+class Scenario(object):
+    def __init__(self, name, changes):
+        self.name = name
+        self.changes = changes
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["name"], [Change.from_dict(change) for change in data.get("changes", [])])
+
+
+def _parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date() if value else None
+
+
+class Schedule(object):
+    """
+    The occurrences of the transactions of all accounts within a prognosis, from the balance date of their account
+    on, grouped per account in chronological order.
+    """
+
+    def __init__(self, month_ordinals, plans):
+        # The forecast without any changes
+        self.base = Forecast.from_plans(month_ordinals, plans)
+        self.month_ordinals = self.base.month_ordinals
+        month_starts = monthcalendar.first_days(self.month_ordinals)
+
+        transactions, months, days, account_bounds = [], [], [], [0]
+        self.account_plans = []
+        offset = 0
+        for plan in plans:
+            if plan.name not in self.base.accounts:
+                continue
+
+            transactions.append(plan.transaction[plan.active] + offset)
+            offset += len(plan.transactions)
+            months.append(plan.month_indexes()[plan.active])
+            days.append(plan.active_days(month_starts))
+            account_bounds.append(account_bounds[-1] + len(transactions[-1]))
+            self.account_plans.append(plan)
+
+        self.transactions = [transaction for plan in self.account_plans for transaction in plan.transactions]
+        self.amounts = np.concatenate([plan.amounts() for plan in self.account_plans] + [np.zeros(0)])
+        self.fields = dict((field, np.array([getattr(transaction, field) for transaction in self.transactions],
+                                            dtype=object)) for field in MATCH_FIELDS)
+
+        # Every occurrence, by its transaction (counted over all accounts), month index and day ordinal
+        self.occurrence_transaction = np.concatenate(transactions or [np.zeros(0, dtype=np.int64)])
+        self.occurrence_month = np.concatenate(months or [np.zeros(0, dtype=np.int64)])
+        self.occurrence_day = np.concatenate(days or [np.zeros(0, dtype=np.int64)])
+        self.account_bounds = np.array(account_bounds)
+        self.occurrence_account = np.repeat(np.arange(len(self.account_plans)), np.diff(self.account_bounds))
+
+        # The occurrences of every transaction, to find those of the matching transactions without going over all
+        self.by_transaction = np.argsort(self.occurrence_transaction, kind="mergesort")
+        self.transaction_bounds = np.searchsorted(self.occurrence_transaction[self.by_transaction],
+                                                  np.arange(len(self.transactions) + 1))
+        self.day_of_month = np.array([transaction.date.day for transaction in self.transactions], dtype=np.int64)
+
+    def _occurrences(self, change):
+        # The occurrences of the transactions matching the change, within its dates.
+        matching = np.ones(len(self.transactions), dtype=bool)
+        for field, value in change.match.items():
+            matching &= self.fields[field] == value
+        transactions = np.flatnonzero(matching)
+
+        starts, lengths = self.transaction_bounds[transactions], np.diff(self.transaction_bounds)[transactions]
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        occurrences = np.sort(self.by_transaction[np.repeat(starts, lengths) + offsets])
+
+        if change.start is not None:
+            occurrences = occurrences[self.occurrence_day[occurrences] >= change.start.toordinal()]
+        if change.end is not None:
+            occurrences = occurrences[self.occurrence_day[occurrences] <= change.end.toordinal()]
+        return occurrences
+
+    def evaluate(self, scenario):
+        """
+        The forecast of the accounts under a scenario. Accounts the scenario does not change keep their forecast.
+        """
+        occurrences = [(self._occurrences(change), change) for change in scenario.changes]
+        changed = np.unique(np.concatenate([found for found, _ in occurrences] + [np.zeros(0, dtype=np.int64)]))
+        multipliers = np.ones(len(changed))
+        shifts = np.zeros(len(changed), dtype=np.int64)
+        for found, change in occurrences:
+            positions = np.searchsorted(changed, found)
+            multipliers[positions] *= change.multiplier
+            shifts[positions] += change.shift
+
+        # The days of the moved occurrences, keeping their day of the month where the month is long enough.
+        months = self.occurrence_month[changed] + shifts
+        ordinals = self.month_ordinals[0] + months
+        days = np.where(shifts != 0, monthcalendar.first_days(ordinals) - 1 +
+                        np.minimum(self.day_of_month[self.occurrence_transaction[changed]],
+                                   monthcalendar.days_in_months(ordinals)), self.occurrence_day[changed])
+
+        accounts = list(self.base.accounts.values())
+        for account_nr in np.unique(self.occurrence_account[changed]).tolist():
+            first, last = self.account_bounds[account_nr:account_nr + 2]
+            base = accounts[account_nr]
+            selected = (changed >= first) & (changed < last)
+
+            account_days = self.occurrence_day[first:last].copy()
+            amounts = self.amounts[self.occurrence_transaction[first:last]]
+            account_days[changed[selected] - first] = np.maximum(days[selected], base.first_day)
+            amounts[changed[selected] - first] *= multipliers[selected]
+
+            # Moved occurrences go after the ones already on their new day.
+            order = np.argsort(account_days, kind="mergesort")
+            accounts[account_nr] = AccountForecast.from_occurrences(
+                base.name, base.currency, base.date, base.balances[0], account_days[order], amounts[order],
+                base.last_day)
+
+        return Forecast(self.month_ordinals, accounts)
+
+    @classmethod
+    def from_workbook(cls, calcbook, years, months, workers=1):
+        sorted_accounts, month_ordinals, plans = calcbook.plan(years, months, workers=workers)
+        return cls(month_ordinals, plans)
+
+    def evaluate_all(self, scenarios):
+        return [(scenario.name, self.evaluate(scenario)) for scenario in scenarios]
+
+
+def read_scenarios(filename):
+    with open(filename) as scenarios_file:
+        entries = json.load(scenarios_file)
+
+    if not isinstance(entries, list):
+        raise ValueError("The scenarios should be a list")
+    return [Scenario.from_dict(entry) for entry in entries]
+
+
+def report(schedule, results):
+    """
+    The month-end balances and the first negative day of every account, in the base forecast and every scenario.
+    """
+    def forecast_report(name, forecast):
+        negatives = forecast.first_negative_dates()
+        return {"name": name, "accounts": [
+            {"name": account, "first_negative": negatives[account].isoformat() if negatives[account] else None,
+             "month_ends": [None if np.isnan(balance) else balance for balance in balances]}
+            for account, balances in zip(forecast.accounts, forecast.month_end_balances().tolist())]}
+
+    return {"months": [monthcalendar.month_title(ordinal) for ordinal in schedule.month_ordinals],
+            "base": forecast_report("base", schedule.base),
+            "scenarios": [forecast_report(name, forecast) for name, forecast in results]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate what-if scenarios on the prognosis of a balance workbook.")
+    parser.add_argument("input", help="the balance workbook")
+    parser.add_argument("years", type=int)
+    parser.add_argument("months", type=int)
+    parser.add_argument("scenarios", help="JSON list of scenarios, each with its name and changes")
+    parser.add_argument("--output", help="file to write the results to, instead of the standard output")
+    parser.add_argument("--cache-dir", default=DEFAULT_DIRECTORY,
+                        help="folder of the cache of parsed inputs (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="always parse the input workbook")
+    args = parser.parse_args()
+
+    calcbook = TransactionWorkbook()
+    calcbook.load(args.input, cache=None if args.no_cache else InputCache(PARSER_VERSION, directory=args.cache_dir))
+    schedule = Schedule.from_workbook(calcbook, args.years, args.months)
+    results = schedule.evaluate_all(read_scenarios(args.scenarios))
+
+    text = json.dumps(report(schedule, results), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print text
+
+
+if __name__ == '__main__':
+    main()
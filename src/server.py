@@ -0,0 +1,239 @@
+"""
+ Local forecast service, keeping parsed balance workbooks loaded between requests.
+
+    GET /balances?input=home.xlsx&years=1&months=0
+        The current balance of every account and its balance at the end of every month of the prognosis, as JSON.
+    GET /prognosis?input=home.xlsx&years=1&months=0[&formulas=1][&write_only=1][&summary=1]
+        The prognosis workbook.
+    GET /status
+        The inputs kept loaded, as JSON.
+
+ Inputs are named relative to the root folder of the service and are only read again once their file changes. The
+ prognoses made of an input are kept along with it, so asking again for the same one does not export it again.
+ Requests are handled each in a thread of their own; requests about the same input wait for each other.
+"""
+
+import os
+import json
+import math
+import shutil
+import urlparse
+import argparse
+import tempfile
+import threading
+from datetime import date
+from collections import OrderedDict
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import monthcalendar
+from forecast import Forecast
+from budgetcalc import BudgetCalc, TransactionWorkbook, PARSER_VERSION
+from inputcache import InputCache, DEFAULT_DIRECTORY
+
+DEFAULT_PORT = 8765
+DEFAULT_MAX_INPUTS = 8
+DEFAULT_MAX_PROGNOSES = 4
+XLSX_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+class LoadedInput(object):
+    """
+    A parsed input as of one modification time of its file, with the prognoses already made of it.
+    """
+
+    def __init__(self, path, mtime, calcbook, max_prognoses=DEFAULT_MAX_PROGNOSES):
+        self.path = path
+        self.mtime = mtime
+        self.calcbook = calcbook
+        self.lock = threading.Lock()
+        self.prognoses = OrderedDict()
+        self.max_prognoses = max_prognoses
+
+    def balances(self, years, months):
+        with self.lock:
+            account_names, month_ordinals, plans = self.calcbook.plan(years, months)
+
+        # Balances are only known from the balance date of an account on, months ending before it have none.
+        forecast = Forecast.from_plans(month_ordinals, plans)
+        known = dict(zip(forecast.accounts, forecast.month_end_balances().tolist()))
+
+        accounts = []
+        for plan in plans:
+            month_ends = [None if math.isnan(balance) else balance
+                          for balance in known.get(plan.name, [float("nan")] * len(month_ordinals))]
+            accounts.append({"name": plan.name, "currency": plan.currency, "balance": plan.balance,
+                             "date": plan.date.isoformat(),
+                             "months": [{"month": monthcalendar.month_title(ordinal), "balance": balance}
+                                        for ordinal, balance in zip(month_ordinals, month_ends)]})
+        return {"input": self.path, "accounts": accounts}
+
+    def prognosis(self, years, months, write_only, formulas, summary):
+        # The prognosis depends on the day it is made.
+        key = (years, months, write_only, formulas, summary, date.today())
+        with self.lock:
+            if key in self.prognoses:
+                self.prognoses[key] = self.prognoses.pop(key)
+                return self.prognoses[key]
+
+            filename = BudgetCalc._compose_filename("", years, months,
+                                                    tag=os.path.splitext(os.path.basename(self.path))[0])
+            folder = tempfile.mkdtemp(prefix="budgetcalc-server-")
+            try:
+                output = os.path.join(folder, "prognosis.xlsx")
+                self.calcbook.export(output, years, months, write_only=write_only, formulas=formulas,
+                                     summary=summary)
+                with open(output, "rb") as output_file:
+                    content = output_file.read()
+            finally:
+                shutil.rmtree(folder)
+
+            self.prognoses[key] = (os.path.basename(filename), content)
+            while len(self.prognoses) > self.max_prognoses:
+                self.prognoses.popitem(last=False)
+            return self.prognoses[key]
+
+
+class InputStore(object):
+    """
+    The most recently used inputs, by path. An input whose file changed is loaded again.
+    """
+
+    def __init__(self, root, max_inputs=DEFAULT_MAX_INPUTS, cache=None):
+        self.root = os.path.realpath(root)
+        self.max_inputs = max_inputs
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.inputs = OrderedDict()
+
+    def resolve(self, name):
+        path = os.path.realpath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            raise RequestError(403, "Inputs must be inside {0}".format(self.root))
+        if not os.path.isfile(path):
+            raise RequestError(404, "No input {0}".format(name))
+        return path
+
+    def get(self, name):
+        path = self.resolve(name)
+        mtime = os.stat(path).st_mtime
+
+        with self.lock:
+            loaded = self.inputs.pop(path, None)
+            if loaded is not None and loaded.mtime == mtime:
+                self.inputs[path] = loaded
+                return loaded
+
+        # Loading is left out of the lock, so requests about other inputs are not held up.
+        calcbook = TransactionWorkbook()
+        calcbook.load(path, cache=self.cache)
+        loaded = LoadedInput(path, mtime, calcbook)
+
+        with self.lock:
+            self.inputs[path] = loaded
+            while len(self.inputs) > self.max_inputs:
+                self.inputs.popitem(last=False)
+        return loaded
+
+    def status(self):
+        with self.lock:
+            return [{"input": loaded.path, "mtime": loaded.mtime, "prognoses": len(loaded.prognoses)}
+                    for loaded in self.inputs.values()]
+
+
+class ForecastHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict((name, values[-1]) for name, values in urlparse.parse_qs(url.query).items())
+        try:
+            if url.path == "/status":
+                self._send_json({"inputs": self.server.inputs.status()})
+            elif url.path == "/balances":
+                loaded = self.server.inputs.get(self._parameter(query, "input"))
+                self._send_json(loaded.balances(*self._horizon(query)))
+            elif url.path == "/prognosis":
+                loaded = self.server.inputs.get(self._parameter(query, "input"))
+                filename, content = loaded.prognosis(*self._horizon(query), write_only=self._flag(query, "write_only"),
+                                                     formulas=self._flag(query, "formulas"),
+                                                     summary=self._flag(query, "summary"))
+                self._send(200, XLSX_TYPE, content, filename=filename)
+            else:
+                raise RequestError(404, "No such resource {0}".format(url.path))
+        except RequestError as error:
+            self._send_json({"error": str(error)}, status=error.status)
+        except Exception as error:
+            self.log_error("%s failed: %r", self.path, error)
+            self._send_json({"error": "{0}: {1}".format(type(error).__name__, error)}, status=500)
+
+    @staticmethod
+    def _parameter(query, name):
+        if name not in query:
+            raise RequestError(400, "Missing parameter {0}".format(name))
+        return query[name]
+
+    @staticmethod
+    def _horizon(query):
+        try:
+            years, months = int(query.get("years", 1)), int(query.get("months", 0))
+        except ValueError:
+            raise RequestError(400, "years and months should be numbers")
+        if years < 0 or months < 0:
+            raise RequestError(400, "years and months should not be negative")
+        return years, months
+
+    @staticmethod
+    def _flag(query, name):
+        return query.get(name, "0").lower() in ("1", "true", "yes")
+
+    def _send_json(self, data, status=200):
+        self._send(status, "application/json", json.dumps(data, indent=2, sort_keys=True, default=str))
+
+    def _send(self, status, content_type, content, filename=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        if filename is not None:
+            self.send_header("Content-Disposition", 'attachment; filename="{0}"'.format(filename))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class ForecastServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, inputs):
+        HTTPServer.__init__(self, address, ForecastHandler)
+        self.inputs = inputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve budget prognoses of local balance workbooks.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--root", default=os.getcwd(), help="folder of the inputs (default: the current folder)")
+    parser.add_argument("--max-inputs", type=int, default=DEFAULT_MAX_INPUTS,
+                        help="number of inputs kept loaded (default: %(default)s)")
+    parser.add_argument("--cache-dir", default=DEFAULT_DIRECTORY,
+                        help="folder of the cache of parsed inputs (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="always parse the input workbooks")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else InputCache(PARSER_VERSION, directory=args.cache_dir)
+    server = ForecastServer((args.host, args.port), InputStore(args.root, max_inputs=args.max_inputs, cache=cache))
+    print "Serving prognoses of {0} on http://{1}:{2}/".format(os.path.realpath(args.root), args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
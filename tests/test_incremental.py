@@ -0,0 +1,115 @@
+"""
+ A prognosis saved incrementally after an edit of the input is the same as the prognosis saved in full.
+"""
+
+import os
+import sys
+import stat
+import time
+import shutil
+import tempfile
+import unittest
+from copy import copy
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+from openpyxl import load_workbook
+
+import benchmark
+import incremental
+import monthcalendar
+from budgetcalc import BudgetCalc
+from incremental import PrognosisStates
+
+# Months after the current one in which the edited transaction takes place
+EDITED_MONTH = 5
+
+
+def set_edited_transaction(filename, amount):
+    # A single payment in one month, so the months before and after it can be reused.
+    year, month = monthcalendar.ordinal_year_month(monthcalendar.date_month(date.today()) + EDITED_MONTH)
+    workbook = load_workbook(filename)
+    sheet = workbook.active
+    row = [cell.value for cell in sheet[sheet.max_row]]
+    if row[1] == "Edited transaction":
+        sheet.cell(row=sheet.max_row, column=5).value = amount
+    else:
+        sheet.append(["Bank 1", "Edited transaction", "limited", "AR$", amount, datetime(year, month, 10), None, 1,
+                      None])
+    workbook.save(filename)
+
+
+def workbook_cells(filename):
+    workbook = load_workbook(filename)
+    cells = []
+    for sheet in workbook.worksheets:
+        widths = sorted((key, dimension.width) for key, dimension in sheet.column_dimensions.items())
+        cells.append((sheet.title, widths))
+        for row in sheet.iter_rows():
+            # The styles of a cell are proxies, only their copies compare by value.
+            cells.extend((cell.coordinate, cell.value, copy(cell.font), copy(cell.fill), cell.number_format,
+                          copy(cell.alignment)) for cell in row)
+    return cells
+
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input = os.path.join(self.directory, "input.xlsx")
+        benchmark.generate_input(self.input, 3, 80, past_months=0)
+        set_edited_transaction(self.input, -100)
+
+        self.reused = []
+        self.splice = incremental.splice
+
+        def splice(previous_output, patched, filename, reused_months):
+            self.reused.append(set(reused_months))
+            self.splice(previous_output, patched, filename, reused_months)
+        incremental.splice = splice
+
+    def tearDown(self):
+        incremental.splice = self.splice
+        shutil.rmtree(self.directory)
+
+    def save(self, folder, states=None, write_only=False):
+        folder = os.path.join(self.directory, folder)
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        calculator = BudgetCalc(states=states)
+        calculator.read_input(self.input)
+        return calculator.save_prognosis(folder, years=1, write_only=write_only)
+
+    def assert_same_as_full(self, write_only):
+        states = PrognosisStates(directory=os.path.join(self.directory, "states"))
+        self.save("incremental", states=states, write_only=write_only)
+        set_edited_transaction(self.input, -250.5)
+        output = self.save("incremental", states=states, write_only=write_only)
+        full_output = self.save("full", write_only=write_only)
+
+        self.assertEqual(len(self.reused), 1)
+        self.assertTrue(self.reused[0])
+        self.assertNotIn(EDITED_MONTH, self.reused[0])
+        self.assertEqual(workbook_cells(output), workbook_cells(full_output))
+        self.assertEqual(stat.S_IMODE(os.stat(output).st_mode), stat.S_IMODE(os.stat(full_output).st_mode))
+
+    def test_edit(self):
+        self.assert_same_as_full(write_only=False)
+
+    def test_edit_write_only(self):
+        self.assert_same_as_full(write_only=True)
+
+    def test_evict_old_states(self):
+        states = PrognosisStates(directory=os.path.join(self.directory, "states"), max_age=3600)
+        self.save("incremental", states=states)
+        kept = states.path(states.key(os.path.join(self.directory, "incremental"), 1, 0))
+        old = states.path("old")
+        shutil.copy(kept, old)
+        os.utime(old, (time.time() - 7200, time.time() - 7200))
+
+        states.evict()
+        self.assertEqual(os.listdir(states.directory), [os.path.basename(kept)])
+
+
+if __name__ == '__main__':
+    unittest.main()
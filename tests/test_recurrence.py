@@ -0,0 +1,109 @@
+"""
+ The batch expansion of recurring transactions gives exactly the months the original export stepped through.
+"""
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import recurrence
+from recurrence import EVEN_MONTHS, UNEVEN_MONTHS
+
+
+def applicable_months(start_month, interval, reps, quotes, num_months):
+    # _calc_applicable_months of the original export, on month ordinals instead of month names.
+    try:
+        if reps == "":
+            quote_num, total_quotes = [int(x) for x in quotes.split('/')]
+            num_reps = (total_quotes - quote_num) + 1
+        else:
+            num_reps = int(reps)
+    except ValueError:
+        num_reps = num_months
+
+    try:
+        interval = step = int(interval)
+    except ValueError:
+        if interval == "":
+            interval = step = 1
+        else:
+            step = 2
+
+    months = [start_month]
+    num_reps -= 1
+    num_months -= step
+
+    month = start_month
+    while num_reps > 0 and num_months > 0:
+        month_num = month % 12 + 1
+        if isinstance(interval, int):
+            increment = interval
+        elif (interval == UNEVEN_MONTHS and month_num % 2) or (interval == EVEN_MONTHS and not month_num % 2):
+            increment = 2
+        else:
+            increment = 1
+        month += increment
+        months.append(month)
+        num_reps -= 1
+        num_months -= increment
+
+    return months
+
+
+def expanded_months(transactions, first_month, num_months):
+    start_months, days, kinds, intervals, steps, reps = [], [], [], [], [], []
+    for start_month, interval, repetitions, quotes in transactions:
+        kind, interval_months, step = recurrence.parse_interval(interval)
+        start_months.append(start_month)
+        days.append(1)
+        kinds.append(kind)
+        intervals.append(interval_months)
+        steps.append(step)
+        reps.append(recurrence.parse_repetitions(repetitions, quotes))
+
+    occurrences = recurrence.expand(start_months, days, kinds, intervals, steps, reps, first_month, num_months)
+    months = [[] for _ in transactions]
+    for transaction, month in zip(occurrences.transaction.tolist(), occurrences.month.tolist()):
+        months[transaction].append(month)
+    return months
+
+
+class ExpandTest(unittest.TestCase):
+    FIRST_MONTH = 2026 * 12 + 9
+
+    def assert_same_months(self, transactions, num_months):
+        expected = [applicable_months(start_month, interval, reps, quotes,
+                                      num_months - (start_month - self.FIRST_MONTH))
+                    for start_month, interval, reps, quotes in transactions]
+        self.assertEqual(expanded_months(transactions, self.FIRST_MONTH, num_months), expected)
+
+    def test_repetitions_below_one(self):
+        # A typed -1 or cuotas past their total are a single occurrence, not unlimited ones.
+        start = self.FIRST_MONTH + 1
+        self.assert_same_months([(start, "", "-1", ""), (start, "", "", "11/9"), (start, "2", "", "3/1"),
+                                 (start, "", "0", ""), (start, EVEN_MONTHS, "-5", "")], 24)
+
+    def test_unlimited(self):
+        start = self.FIRST_MONTH - 3
+        self.assert_same_months([(start, "", "", ""), (start, "3", "", "x"), (start, UNEVEN_MONTHS, "", ""),
+                                 (start, "Quarterly", "", "")], 13)
+
+    def test_random_transactions(self):
+        rnd = random.Random(1)
+        intervals = ["", EVEN_MONTHS, UNEVEN_MONTHS, "Other"] + [str(n) for n in range(-2, 14)]
+        for _ in range(20):
+            num_months = rnd.randint(1, 60)
+            transactions = []
+            for _ in range(2000):
+                start_month = self.FIRST_MONTH + rnd.randint(-30, num_months + 2)
+                reps = rnd.choice(["", "", "x", str(rnd.randint(-3, 30))])
+                quotes = rnd.choice(["", "x", "{0}/{1}".format(rnd.randint(0, 15), rnd.randint(0, 15))])
+                transactions.append((start_month, rnd.choice(intervals), reps, quotes))
+            self.assert_same_months(transactions, num_months)
+
+
+if __name__ == '__main__':
+    unittest.main()
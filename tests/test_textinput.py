@@ -0,0 +1,104 @@
+"""
+ Inputs saved as text (CSV) give the same accounts and transactions as the same input saved as a workbook.
+"""
+
+import os
+import csv
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+from openpyxl import Workbook
+
+from budgetcalc import TransactionWorkbook
+
+ACCOUNTS = [["Bank 1", "AR$", 1500.5, datetime(2026, 10, 5)],
+            ["Bank 2", "US$", -20, datetime(2026, 11, 20)]]
+
+TRANSACTIONS = [["Bank 1", "Rent", "Home", "AR$", -1200, datetime(2026, 10, 1), None, None, None],
+                ["Bank 1", "TV", "Home", "AR$", -120.25, datetime(2026, 12, 10), None, None, "3/12"],
+                ["Bank 2", "Salary", "Work", "US$", 2500.75, datetime(2026, 11, 28), 1, 12, None],
+                ["Bank 2", "Insurance", "", "US$", -80, datetime(2027, 1, 15), "Even months", None, None],
+                ["Bank 1", "Gift", "Family", "AR$", 50, datetime(2026, 10, 30), "foo", 1, None]]
+
+
+def text_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.strftime("%d-%m-%Y")
+    return str(value)
+
+
+class TextInputTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_text(self, accounts, transactions):
+        filename = os.path.join(self.directory, "input.csv")
+        with open(filename, "wb") as text_file:
+            writer = csv.writer(text_file)
+            writer.writerow(TransactionWorkbook.BANKS_COLS)
+            writer.writerows([text_value(value) for value in row] for row in accounts)
+            writer.writerow([])
+            writer.writerow(TransactionWorkbook.BALANCES_COLS)
+            writer.writerows([text_value(value) for value in row] for row in transactions)
+        return filename
+
+    def write_workbook(self, accounts, transactions):
+        filename = os.path.join(self.directory, "input.xlsx")
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.append(TransactionWorkbook.BANKS_COLS)
+        for row in accounts:
+            sheet.append(row)
+        sheet.append([])
+        sheet.append(TransactionWorkbook.BALANCES_COLS)
+        for row in transactions:
+            sheet.append(row)
+        workbook.save(filename)
+        return filename
+
+    def load(self, filename, decimal_mark="."):
+        calcbook = TransactionWorkbook()
+        calcbook.load(filename, decimal_mark=decimal_mark)
+        return calcbook
+
+    def load_balance(self, balance, decimal_mark="."):
+        account = ["Bank 1", "AR$", balance, "05-10-2026"]
+        return self.load(self.write_text([account], []), decimal_mark=decimal_mark).accounts[0].balance
+
+    def test_thousands_separator(self):
+        self.assertEqual(self.load_balance("1,500.00"), 1500.0)
+        self.assertEqual(self.load_balance("-2,001,500"), -2001500)
+        self.assertEqual(self.load_balance("1500.25"), 1500.25)
+
+    def test_decimal_comma(self):
+        self.assertEqual(self.load_balance("1.500,00", decimal_mark=","), 1500.0)
+        self.assertEqual(self.load_balance("0,5", decimal_mark=","), 0.5)
+
+    def test_invalid_numbers(self):
+        for balance in ["1,50", "abc", "1.500,00"]:
+            with self.assertRaisesRegexp(ValueError, "Invalid balance .* in row 2"):
+                self.load_balance(balance)
+
+    def test_same_as_workbook(self):
+        text = self.load(self.write_text(ACCOUNTS, TRANSACTIONS))
+        workbook = self.load(self.write_workbook(ACCOUNTS, TRANSACTIONS))
+
+        self.assertEqual(text.accounts, workbook.accounts)
+        query = "SELECT * FROM transactions ORDER BY rowid"
+        transactions = text.db_cursor.execute(query).fetchall()
+        self.assertEqual(len(transactions), len(TRANSACTIONS))
+        self.assertEqual(transactions, workbook.db_cursor.execute(query).fetchall())
+
+
+if __name__ == '__main__':
+    unittest.main()